@@ -2,100 +2,544 @@
 Helper functions that interact with OpenAI
 """
 
+import asyncio
+import base64
+import time
+import wave
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
 
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, AuthenticationError, DefaultAsyncHttpxClient
 from openai.types.responses import Response
 
-from db_utils import CommandContext, get_api_key, get_response_id, update_chat
+from audio_helpers import PCM_CHANNELS, PCM_SAMPLE_RATE, PCM_SAMPLE_WIDTH, SpeechStream, read_pcm, split_sentences
+from content_store import index_artifact
+from db_utils import CommandContext, get_api_key, get_chat, increment_usage, update_chat
+from fair_queue import openai_scheduler, record_api_time
+from metrics import observe_span, traced
+from openai_requests import call_with_retries, get_breaker
+from speech_cache import lookup_speech, speech_cache_key, store_speech
 
 
-def get_config():
+CONFIG_FILE = Path("config.ini")
+CONFIG_CHECK_INTERVAL = 5.0
+DEFAULT_REQUEST_TIMEOUT = 60.0
+# used when config.ini predates the compact_conversation prompt
+DEFAULT_COMPACT_PROMPT = (
+    "Summarize our conversation so far for your own future reference. Keep every name, fact, decision and open "
+    "question that a later reply might need, and leave out pleasantries."
+)
+
+# decoding and writing generated content happens here so large files don't stall the gateway heartbeat
+io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="content-io")
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    The parsed contents of the config ini
+    """
+
+    parser: ConfigParser
+    instructions: Dict[str, str]
+    prompts: Dict[str, str]
+    model_limits: Dict[str, int]
+    user_model_limits: Dict[str, int]
+    speech_model: str
+    speech_concurrency: int
+    speech_cache_bytes: int
+    vision_model: str
+    max_output_tokens: int
+    chat_compact_tokens: int
+    request_timeouts: Dict[str, float]
+    request_retries: int
+    breaker_failures: int
+    breaker_reset_seconds: float
+    speech_hedge_seconds: float
+    max_concurrent_requests: int
+    max_guild_concurrent_requests: int
+    guild_weights: Dict[int, float]
+    max_clean_minutes: int
+    talk_prefetch_seconds: float
+    rather_pool_size: int
+    stream_edit_interval: float
+    max_attachment_bytes: int
+    dev_guild_id: int
+    metrics_host: str
+    metrics_port: int
+    storage_guild_quota_bytes: int
+    storage_max_age_days: float
+    storage_transcode_after_days: float
+    storage_sweep_minutes: float
+
+
+_settings: Optional[Settings] = None
+_settings_mtime: Optional[float] = None
+_settings_checked = 0.0
+
+
+def load_settings(path: Path = CONFIG_FILE) -> Settings:
     """
-    Read the configuration specified in the config ini
+    Read and parse the configuration specified in the config ini
     """
     config = ConfigParser()
-    config.read("config.ini")
-    return config
+    config.read(path)
+
+    return Settings(
+        parser=config,
+        instructions=dict(config["OPENAI_INSTRUCTIONS"]) if config.has_section("OPENAI_INSTRUCTIONS") else {},
+        prompts=dict(config["PROMPTS"]) if config.has_section("PROMPTS") else {},
+        model_limits=(
+            {model: int(count) for model, count in config["OPENAI_MODEL_LIMITS"].items()}
+            if config.has_section("OPENAI_MODEL_LIMITS")
+            else {}
+        ),
+        user_model_limits=(
+            {model: int(count) for model, count in config["OPENAI_USER_MODEL_LIMITS"].items()}
+            if config.has_section("OPENAI_USER_MODEL_LIMITS")
+            else {}
+        ),
+        speech_model=config.get("OPENAI_GENERAL", "speech_model", fallback="tts-1"),
+        speech_concurrency=config.getint("OPENAI_GENERAL", "speech_concurrency", fallback=3),
+        speech_cache_bytes=config.getint("OPENAI_GENERAL", "speech_cache_mb", fallback=512) * 1024 * 1024,
+        vision_model=config.get("OPENAI_GENERAL", "vision_model", fallback="gpt-4o"),
+        max_output_tokens=config.getint("OPENAI_GENERAL", "max_output_tokens", fallback=500),
+        chat_compact_tokens=config.getint("OPENAI_GENERAL", "chat_compact_tokens", fallback=8000),
+        request_timeouts=(
+            {endpoint: float(seconds) for endpoint, seconds in config["OPENAI_TIMEOUTS"].items()}
+            if config.has_section("OPENAI_TIMEOUTS")
+            else {}
+        ),
+        request_retries=config.getint("OPENAI_GENERAL", "request_retries", fallback=3),
+        breaker_failures=config.getint("OPENAI_GENERAL", "circuit_breaker_failures", fallback=5),
+        breaker_reset_seconds=config.getfloat("OPENAI_GENERAL", "circuit_breaker_reset_seconds", fallback=30.0),
+        speech_hedge_seconds=config.getfloat("OPENAI_GENERAL", "speech_hedge_seconds", fallback=1.5),
+        max_concurrent_requests=config.getint("OPENAI_GENERAL", "max_concurrent_requests", fallback=16),
+        max_guild_concurrent_requests=config.getint("OPENAI_GENERAL", "max_guild_concurrent_requests", fallback=4),
+        guild_weights=(
+            {int(guild_id): float(weight) for guild_id, weight in config["OPENAI_GUILD_WEIGHTS"].items()}
+            if config.has_section("OPENAI_GUILD_WEIGHTS")
+            else {}
+        ),
+        max_clean_minutes=config.getint("GENERAL", "max_clean_minutes", fallback=1440),
+        talk_prefetch_seconds=config.getfloat("GENERAL", "talk_prefetch_seconds", fallback=30.0),
+        rather_pool_size=config.getint("GENERAL", "rather_pool_size", fallback=3),
+        stream_edit_interval=config.getfloat("DISCORD", "stream_edit_interval", fallback=1.0),
+        max_attachment_bytes=config.getint("DISCORD", "max_attachment_mb", fallback=20) * 1024 * 1024,
+        dev_guild_id=config.getint("DISCORD", "dev_guild_id", fallback=0),
+        metrics_host=config.get("METRICS", "host", fallback="127.0.0.1"),
+        metrics_port=config.getint("METRICS", "port", fallback=0),
+        storage_guild_quota_bytes=config.getint("STORAGE", "guild_quota_mb", fallback=0) * 1024 * 1024,
+        storage_max_age_days=config.getfloat("STORAGE", "max_age_days", fallback=0),
+        storage_transcode_after_days=config.getfloat("STORAGE", "transcode_after_days", fallback=0),
+        storage_sweep_minutes=config.getfloat("STORAGE", "sweep_minutes", fallback=60.0),
+    )
+
+
+def reload_config() -> Settings:
+    """
+    Re-read the config ini right away, e.g. from a signal handler
+    """
+    global _settings, _settings_mtime, _settings_checked  # pylint: disable=W0603
+
+    try:
+        _settings_mtime = CONFIG_FILE.stat().st_mtime
+    except OSError:
+        _settings_mtime = None
+
+    _settings = load_settings()
+    _settings_checked = time.monotonic()
+    return _settings
+
+
+def get_settings() -> Settings:
+    """
+    Return the cached configuration, re-reading the config ini only when its mtime has changed
+    """
+    global _settings_checked  # pylint: disable=W0603
+
+    if _settings is None:
+        return reload_config()
+
+    # only stat the file every few seconds so the hot path stays free of file I/O
+    now = time.monotonic()
+    if now - _settings_checked >= CONFIG_CHECK_INTERVAL:
+        _settings_checked = now
+        try:
+            mtime = CONFIG_FILE.stat().st_mtime
+        except OSError:
+            mtime = None
+        if mtime != _settings_mtime:
+            return reload_config()
+
+    return _settings
+
+
+def get_config() -> ConfigParser:
+    """
+    Return the cached ConfigParser for options that don't have a typed field in Settings
+    """
+    return get_settings().parser
+
+
+CLIENT_CACHE_SIZE = 64
+CLIENT_CACHE_TTL = 3600.0
+CLIENT_CLOSE_DELAY = 300.0
+
+# guild_id -> (client, created) in least-recently-used order
+_openai_clients: "OrderedDict[int, Tuple[AsyncOpenAI, float]]" = OrderedDict()
+client_cache_stats: Dict[str, int] = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0,
+    "requests": 0,
+    "connections": 0,
+}
+
+
+async def _trace_connections(event_name: str, _info: Dict[str, Any]) -> None:
+    if event_name == "connection.connect_tcp.complete":
+        client_cache_stats["connections"] += 1
+
+
+async def _count_request(request: httpx.Request) -> None:
+    client_cache_stats["requests"] += 1
+    request.extensions["trace"] = _trace_connections
+
+
+def _retire_client(guild_id: int) -> None:
+    """
+    Drop a client from the cache and close it once any in-flight requests have had time to finish
+    """
+    openai_client, _ = _openai_clients.pop(guild_id)
+    asyncio.get_running_loop().call_later(
+        CLIENT_CLOSE_DELAY, lambda: asyncio.create_task(openai_client.close())
+    )
+
+
+def invalidate_openai_client(guild_id: int) -> None:
+    """
+    Forget a guild's cached client, e.g. after its API key has been rotated
+    """
+    if guild_id in _openai_clients:
+        client_cache_stats["invalidations"] += 1
+        _retire_client(guild_id)
 
 
 async def get_openai_client(guild_id: int) -> AsyncOpenAI:
     """
-    Return the guild-assigned API key
+    Return a client for the guild-assigned API key, reusing a cached client and its connection pool when possible
     """
+    cached = _openai_clients.get(guild_id)
+    if cached and time.monotonic() - cached[1] < CLIENT_CACHE_TTL:
+        _openai_clients.move_to_end(guild_id)
+        client_cache_stats["hits"] += 1
+        return cached[0]
+
+    client_cache_stats["misses"] += 1
     api_key = await get_api_key(guild_id=guild_id)
-    openai_client = AsyncOpenAI(api_key=api_key)
+
+    # another command may have refreshed the cache while we were reading the key
+    current = _openai_clients.get(guild_id)
+    if current and current is not cached:
+        return current[0]
+    if current:
+        _retire_client(guild_id)
+
+    # call_openai does the retrying, so the SDK's own retries would only multiply the attempts
+    openai_client = AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(event_hooks={"request": [_count_request]}),
+    )
+    _openai_clients[guild_id] = (openai_client, time.monotonic())
+
+    while len(_openai_clients) > CLIENT_CACHE_SIZE:
+        client_cache_stats["evictions"] += 1
+        _retire_client(next(iter(_openai_clients)))
 
     return openai_client
 
 
+async def call_openai(
+    guild_id: int,
+    endpoint: str,
+    make_request: Callable[[], Awaitable[T]],
+    model: str = "",
+    hedge: bool = False,
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+) -> T:
+    """
+    Send an OpenAI request with the endpoint's timeout, retries with backoff, and the guild's circuit breaker.
+    Hedged requests are duplicated when they're slower than speech_hedge_seconds.
+    Requests wait their guild's turn for one of the scheduler's slots; a stream only holds its slot until it opens.
+    Time spent queueing and time spent on the request are recorded as spans labelled with the model.
+    """
+    settings = get_settings()
+    openai_scheduler.global_limit = settings.max_concurrent_requests
+    openai_scheduler.guild_limit = settings.max_guild_concurrent_requests
+    openai_scheduler.weights = settings.guild_weights
+
+    # the slot is held through retries, so a guild that's being rate limited backs off without crowding others
+    queued = time.monotonic()
+    async with openai_scheduler.slot(guild_id=guild_id):
+        started = time.monotonic()
+        observe_span("openai_queue", started - queued, model=model)
+        try:
+            return await call_with_retries(
+                make_request=make_request,
+                breaker=get_breaker(
+                    guild_id=guild_id,
+                    failure_threshold=settings.breaker_failures,
+                    reset_seconds=settings.breaker_reset_seconds,
+                ),
+                timeout=settings.request_timeouts.get(endpoint, DEFAULT_REQUEST_TIMEOUT),
+                retries=settings.request_retries,
+                hedge_after=settings.speech_hedge_seconds if hedge else None,
+                discard=discard,
+                description=f"OpenAI {endpoint} request for guild {guild_id}",
+            )
+        except AuthenticationError:
+            # the key was rotated or revoked, so the next request should read the new one instead of the cached client
+            invalidate_openai_client(guild_id)
+            raise
+        finally:
+            record_api_time(time.monotonic() - started)
+            observe_span(f"openai_{endpoint}", time.monotonic() - started, model=model)
+
+
 async def new_response(
     context: CommandContext,
     prompt: str,
     openai_client: Optional[AsyncOpenAI] = None,
     model: str = "gpt-4o-mini",
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> Response:
     """
-    Generate a new response with the OpenAI Response API and store its ID
+    Generate a new response with the OpenAI Response API and store its ID.
+    If on_text is given, the response is streamed and on_text receives the accumulated text after every delta.
+    The turn's token usage and latency are recorded in context.params["usage"].
     """
-    config = get_config()
+    settings = get_settings()
 
     # topic-specific models
     if context.params.get("topic") == "talk_quotes":
         model = "gpt-4o"
 
     # use command-specified custom instructions --> for future commands
-    instructions = context.params.get("custom_instructions") or config.get(
-        "OPENAI_INSTRUCTIONS", context.params.get("topic")
-    )
+    instructions = context.params.get("custom_instructions") or settings.instructions.get(context.params.get("topic"))
 
     # limit the response output to conform to Discord character limit
-    max_output_tokens = config.getint("OPENAI_GENERAL", "max_output_tokens", fallback=500)
+    max_output_tokens = settings.max_output_tokens
 
     if not openai_client:
         openai_client = await get_openai_client(guild_id=context.guild_id)
 
-    previous_response_id = await get_response_id(context=context)
-
-    response = await openai_client.responses.create(
-        input=prompt,
-        model=model,
-        instructions=instructions,
-        previous_response_id=previous_response_id,
-        max_output_tokens=max_output_tokens,
+    chat = await get_chat(context=context)
+    previous_response_id = chat.response_id if chat else None
+    turn = chat.turns + 1 if chat else 1
+    request_input: Any = prompt
+    compaction_tokens = 0
+
+    # every turn re-bills the whole chain, so once it grows too long fold it into a summary and start a new one
+    if chat and 0 < settings.chat_compact_tokens <= chat.context_tokens:
+        summary = await call_openai(
+            guild_id=context.guild_id,
+            endpoint="responses",
+            model=model,
+            make_request=lambda: openai_client.responses.create(
+                input=settings.prompts.get("compact_conversation", DEFAULT_COMPACT_PROMPT),
+                model=model,
+                previous_response_id=previous_response_id,
+                max_output_tokens=max_output_tokens,
+            ),
+        )
+        compaction_tokens = summary.usage.total_tokens if summary.usage else 0
+        previous_response_id = None
+        request_input = [
+            {"role": "developer", "content": f"A summary of the conversation so far:\n{summary.output_text}"},
+            {"role": "user", "content": prompt},
+        ]
+
+    request = {
+        "input": request_input,
+        "model": model,
+        "instructions": instructions,
+        "previous_response_id": previous_response_id,
+        "max_output_tokens": max_output_tokens,
+    }
+
+    started = time.monotonic()
+    if on_text:
+        response = await stream_response(
+            guild_id=context.guild_id, openai_client=openai_client, request=request, on_text=on_text
+        )
+    else:
+        response = await call_openai(
+            guild_id=context.guild_id,
+            endpoint="responses",
+            model=model,
+            make_request=lambda: openai_client.responses.create(**request),
+        )
+
+    usage = {
+        "turn": turn,
+        "input_tokens": response.usage.input_tokens if response.usage else 0,
+        "output_tokens": response.usage.output_tokens if response.usage else 0,
+        "latency": round(time.monotonic() - started, 3),
+    }
+    if compaction_tokens:
+        usage["compaction_tokens"] = compaction_tokens
+    context.params["usage"] = usage
+
+    # the next turn's input is this turn's input plus its output
+    await update_chat(
+        response_id=response.id,
+        context=context,
+        context_tokens=usage["input_tokens"] + usage["output_tokens"],
+        turns=turn,
     )
 
-    await update_chat(response_id=response.id, context=context)
+    return response
+
+
+async def stream_response(
+    guild_id: int,
+    openai_client: AsyncOpenAI,
+    request: Dict[str, Any],
+    on_text: Callable[[str], Awaitable[None]],
+) -> Response:
+    """
+    Consume a Responses API event stream, reporting text as it arrives, and return the final Response.
+    Only opening the stream is retried; text that has already been shown can't be taken back.
+    """
+    text = ""
+    response = None
+
+    stream = await call_openai(
+        guild_id=guild_id,
+        endpoint="responses",
+        model=request["model"],
+        make_request=lambda: openai_client.responses.create(**request, stream=True),
+    )
+    async with asyncio.timeout(get_settings().request_timeouts.get("responses", DEFAULT_REQUEST_TIMEOUT)):
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                text += event.delta
+                await on_text(text)
+            elif event.type in ("response.completed", "response.incomplete", "response.failed"):
+                response = event.response
+
+    if response is None:
+        raise RuntimeError("The response stream ended without a final response.")
+    if response.error:
+        raise RuntimeError(f"The response failed: {response.error.message}")
 
     return response
 
 
+@traced("tts")
 async def generate_speech(
     context: CommandContext,
     file_name: str,
     tts: str,
     voice: str = "onyx",
     openai_client: Optional[AsyncOpenAI] = None,
+    stream: Optional[SpeechStream] = None,
 ) -> Path:
     """
-    Use OpenAI's Speech API to create a text-to-speech audio file
+    Use OpenAI's Speech API to create a text-to-speech WAV file.
+    Long text is split into sentences that are synthesized concurrently and stitched back together in order.
+    If a SpeechStream is given, the audio is also fed to it as it arrives so playback can start right away.
+    Repeated text/voice pairs are served from the speech cache without calling the API.
     """
-    config = get_config()
-
-    if not openai_client:
-        openai_client = await get_openai_client(guild_id=context.guild_id)
+    settings = get_settings()
+    cache_key = speech_cache_key(text=tts, voice=voice, speech_model=settings.speech_model)
+    chunks = split_sentences(tts)
+    semaphore = asyncio.Semaphore(settings.speech_concurrency)
+    audio_queues: List["asyncio.Queue[bytes]"] = [asyncio.Queue() for _ in chunks]
+    tasks: List[asyncio.Task] = []
+
+    async def synthesize(text: str, audio_queue: "asyncio.Queue[bytes]") -> None:
+        try:
+            async with semaphore:
+                # request raw PCM so chunks can be played before the response is complete.
+                # speech is what people are waiting to hear, so a slow start is hedged with a second request
+                speech = await call_openai(
+                    guild_id=context.guild_id,
+                    endpoint="speech",
+                    model=settings.speech_model,
+                    make_request=lambda: openai_client.audio.speech.with_streaming_response.create(
+                        model=settings.speech_model,
+                        voice=voice,
+                        input=text,
+                        response_format="pcm",
+                    ).__aenter__(),
+                    hedge=True,
+                    discard=lambda speech: speech.close(),
+                )
+                # only opening the response is covered by call_openai's timeout; a stalled body would otherwise
+                # hold up the guild's voice queue until the SDK gives up
+                try:
+                    async with asyncio.timeout(settings.request_timeouts.get("speech", DEFAULT_REQUEST_TIMEOUT)):
+                        async for data in speech.iter_bytes():
+                            audio_queue.put_nowait(data)
+                finally:
+                    await speech.close()
+        finally:
+            audio_queue.put_nowait(b"")
+
+    if stream:
+        # lets the player replay this text's encoded audio, or remember it for next time
+        stream.cache_key = cache_key
+
+    try:
+        if settings.speech_cache_bytes > 0 and (cached_path := await lookup_speech(cache_key)):
+            if stream:
+                stream.feed(await asyncio.to_thread(read_pcm, cached_path))
+            return cached_path
+
+        if not openai_client:
+            openai_client = await get_openai_client(guild_id=context.guild_id)
+
+        tasks = [asyncio.create_task(synthesize(*args)) for args in zip(chunks, audio_queues)]
 
-    async with openai_client.audio.speech.with_streaming_response.create(
-        model=config.get("OPENAI_GENERAL", "speech_model", fallback="tts-1"),
-        voice=voice,
-        input=tts,
-        response_format=config.get("OPENAI_GENERAL", "speech_file_format", fallback="wav"),
-    ) as speech:
         file_path = content_path(context=context, file_name=file_name)
-        await speech.stream_to_file(file_path)
+        with wave.open(str(file_path), "wb") as wav_file:
+            wav_file.setnchannels(PCM_CHANNELS)
+            wav_file.setsampwidth(PCM_SAMPLE_WIDTH)
+            wav_file.setframerate(PCM_SAMPLE_RATE)
+
+            # drain the chunks in sentence order; later sentences keep synthesizing in the background
+            for task, audio_queue in zip(tasks, audio_queues):
+                while data := await audio_queue.get():
+                    wav_file.writeframesraw(data)
+                    if stream:
+                        stream.feed(data)
+                await task
+    except BaseException:
+        # audio that was cut short mustn't be replayed as this text
+        if stream:
+            stream.cache_key = None
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        if stream:
+            stream.finish()
+
+    await index_artifact(guild_id=context.guild_id, command_name=context.command_name, path=file_path)
+    await store_speech(key=cache_key, file_path=file_path, max_bytes=settings.speech_cache_bytes)
 
     return file_path
 
@@ -103,68 +547,158 @@ async def generate_speech(
 async def speak_and_spell(
     context: CommandContext,
     prompt: str,
+    stream: Optional[SpeechStream] = None,
 ) -> Tuple[str, Path]:
     """
     Create a new response and WAV file in one nice function.
     """
-    openai_client = await get_openai_client(guild_id=context.guild_id)
-
-    response = await new_response(context=context, prompt=prompt, openai_client=openai_client)
+    try:
+        openai_client = await get_openai_client(guild_id=context.guild_id)
+        response = await new_response(context=context, prompt=prompt, openai_client=openai_client)
+    except Exception:
+        if stream:
+            stream.finish()
+        raise
 
     tts = response.output_text
 
     file_path = await generate_speech(
-        context=context, tts=tts, file_name=f"{response.id}.wav", openai_client=openai_client
+        context=context, tts=tts, file_name=f"{response.id}.wav", openai_client=openai_client, stream=stream
     )
 
     return tts, file_path
 
 
+async def generate_image(context: CommandContext, openai_client: Optional[AsyncOpenAI] = None, **params: Any) -> Any:
+    """
+    Generate an image with OpenAI's Images API
+    """
+    if not openai_client:
+        openai_client = await get_openai_client(guild_id=context.guild_id)
+
+    return await call_openai(
+        guild_id=context.guild_id,
+        endpoint="images",
+        model=params.get("model", ""),
+        make_request=lambda: openai_client.images.generate(**params),
+    )
+
+
+async def describe_image(
+    context: CommandContext, prompt: str, image_url: str, openai_client: Optional[AsyncOpenAI] = None
+) -> Response:
+    """
+    Ask the vision model about an image
+    """
+    settings = get_settings()
+
+    if not openai_client:
+        openai_client = await get_openai_client(guild_id=context.guild_id)
+
+    return await call_openai(
+        guild_id=context.guild_id,
+        endpoint="responses",
+        model=settings.vision_model,
+        make_request=lambda: openai_client.responses.create(
+            model=settings.vision_model,
+            input=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": prompt},
+                        {"type": "input_image", "image_url": image_url},
+                    ],
+                }
+            ],
+            max_output_tokens=settings.max_output_tokens,
+        ),
+    )
+
+
+@traced("file_io")
+async def run_in_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run blocking file work on the content I/O thread pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, partial(func, *args, **kwargs))
+
+
+@lru_cache(maxsize=1024)
+def content_dir(guild_id: int, day: str, command_name: str) -> Path:
+    """
+    Create a directory for generated content, once per guild, day and command
+    """
+    dir_path = Path(f"generated_content/guild_{guild_id}/{day}/{command_name}")
+    dir_path.mkdir(parents=True, exist_ok=True)
+    return dir_path
+
+
 def content_path(context: CommandContext, file_name: str) -> Path:
     """
     Create a path to store the content generated by OpenAI.
     """
     ts = datetime.now().strftime(format="%Y-%m-%d - %A")
-    dir_path = Path(f"generated_content/guild_{context.guild_id}/{ts}/{context.command_name}")
-    dir_path.mkdir(parents=True, exist_ok=True)
-    return dir_path / file_name
+    return content_dir(context.guild_id, ts, context.command_name) / file_name
 
 
-def check_model_limit(context: CommandContext, usage_tracker: dict) -> bool:
+async def decode_b64(data: str) -> bytes:
     """
-    A function to check if a model's usage has reached a limit specified in the config
+    Decode a (potentially multi-megabyte) base64 payload off the event loop
     """
-    config = get_config()
-    model: str = context.params.get("model")
-    usage_limits = {model: int(count) for model, count in config["OPENAI_MODEL_LIMITS"].items()}
-    limit = usage_limits.get(model)
+    return await run_in_io(base64.b64decode, data)
 
-    # do not limit models that don't have a specified limit in the config
-    if not limit:
-        return True
 
-    today = datetime.now().strftime("%Y-%m-%d")
+async def save_content(context: CommandContext, file_name: str, data: bytes) -> Path:
+    """
+    Write generated content to its content path off the event loop
+    """
+
+    def write() -> Path:
+        path = content_path(context=context, file_name=file_name)
+        path.write_bytes(data)
+        return path
+
+    path = await run_in_io(write)
+    await index_artifact(guild_id=context.guild_id, command_name=context.command_name, path=path)
+    return path
 
-    # create a blank dictionary for a guild if it isn't present in the map already
-    if context.guild_id not in usage_tracker:
-        usage_tracker[context.guild_id] = {}
 
-    # initialize a model usage dict for the limited-use model
-    if model not in usage_tracker[context.guild_id]:
-        usage_tracker[context.guild_id][model] = {"count": 0, "last_reset": today, "limit": limit}
+# (scope, model, day, limit) quotas known to be used up, so repeat attempts don't need a database write.
+# The limit is part of the key so raising it in config.ini takes effect without waiting for tomorrow.
+_exhausted_usage: set = set()
 
-    record = usage_tracker[context.guild_id][model]
 
-    # reset the usage on a new day
-    if record["last_reset"] != today:
-        record["count"] = 0
-        record["last_reset"] = today
-        record["limit"] = limit
+async def check_model_limit(context: CommandContext) -> Tuple[bool, Optional[int], Optional[int]]:
+    """
+    Count a use of a model against the daily limits specified in the config for the guild and, optionally, the user.
+    Returns whether the use is allowed, plus the guild's count and limit for that model.
+    Counts live in the database, so they survive restarts and are shared between processes.
+    """
+    settings = get_settings()
+    model: str = context.params.get("model")
+
+    limits = {}
+    if guild_limit := settings.model_limits.get(model):
+        limits[f"guild:{context.guild_id}"] = guild_limit
+    if user_limit := settings.user_model_limits.get(model):
+        limits[f"user:{context.user_id}"] = user_limit
+
+    # do not limit models that don't have a specified limit in the config
+    if not limits:
+        return True, None, None
+
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    if any((scope, model, today, limit) in _exhausted_usage for scope, limit in limits.items()):
+        return False, None, guild_limit
 
-    if record["count"] >= limit:
-        return False  # Limit reached
+    exhausted_scope, counts = await increment_usage(model=model, period=today, limits=limits)
 
-    # increment the count
-    record["count"] += 1
+    if exhausted_scope:
+        # forget earlier days' entries while we're here
+        _exhausted_usage.difference_update({entry for entry in _exhausted_usage if entry[2] != today})
+        _exhausted_usage.add((exhausted_scope, model, today, limits[exhausted_scope]))
+        return False, None, guild_limit
 
-    return True
+    return True, counts.get(f"guild:{context.guild_id}"), guild_limit
@@ -1,409 +1,754 @@
-# pylint: disable=C0116
-"""
-A simple Discord Bot that utilizes the OpenAI API.
-"""
-
-import asyncio
-import base64
-import os
-from datetime import datetime, timedelta
-from pathlib import Path
-from typing import Literal, Optional
-from urllib.request import Request, urlopen
-
-import discord
-from discord import Embed, FFmpegOpusAudio, Intents, Interaction, app_commands
-from openai import BadRequestError
-from openai.types import Image
-
-from ai_helpers import (
-    check_model_limit,
-    content_path,
-    generate_speech,
-    get_config,
-    get_openai_client,
-    new_response,
-    speak_and_spell,
-)
-from db_utils import create_command_context
-
-# Bot Client
-intents = Intents.default()
-intents.messages = True
-intents.guilds = True
-
-bot = discord.Client(intents=intents)
-tree = discord.app_commands.CommandTree(bot)
-
-USER_AGENT = "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.3"
-usage_tracker = {}  # blank dict created to store model usage for restricted models
-
-
-@tree.command(name="join", description="Join the voice channel that the user is currently in.")
-async def join(interaction: Interaction) -> None:
-    context = await create_command_context(interaction)
-
-    if interaction.user.voice:
-        await interaction.user.voice.channel.connect()
-        await interaction.response.send_message(content="I have joined the voice chat.", delete_after=3.0)
-    else:
-        await interaction.response.send_message(content=f"{interaction.user.name} is not in a voice channel.")
-
-    return await context.save()
-
-
-@tree.command(name="leave", description="Leave the voice channel that the bot is currently in.")
-async def leave(interaction: Interaction) -> None:
-    context = await create_command_context(interaction)
-
-    if interaction.guild.voice_client:
-        await interaction.guild.voice_client.disconnect()
-        await interaction.response.send_message(content="I have left the voice chat.", delete_after=3.0)
-
-    return await context.save()
-
-
-@tree.command(name="clean", description="Delete messages sent by the bot within a specified timeframe.")
-@app_commands.describe(number_of_minutes="The number of minutes to look back for message deletion.")
-async def clean(interaction: Interaction, number_of_minutes: int) -> None:
-    context = await create_command_context(interaction, params={"number_of_minutes": number_of_minutes})
-    config = get_config()
-
-    max_clean_minutes = int(config.get("GENERAL", "max_clean_minutes", fallback=1440))
-    if max_clean_minutes < number_of_minutes:
-        await interaction.response.send_message(content=f"Can't clean more than {max_clean_minutes} minutes back.")
-        return
-
-    after_time = datetime.now() - timedelta(minutes=number_of_minutes)
-    messages = interaction.channel.history(after=after_time)
-
-    bot_id = bot.user.id
-    sleep_seconds = float(config.get("GENERAL", "clean_sleep", fallback=0.75))
-
-    await interaction.response.send_message(content="Deleting messages...")
-
-    async for message in messages:
-        if message.author.id == bot_id:
-            await asyncio.sleep(sleep_seconds)
-            await message.delete()
-
-    return await context.save()
-
-
-@tree.command(name="talk", description="Start a loop where the bot talks about a specified topic at regular intervals.")
-@app_commands.describe(
-    topic="The topic the bot will talk about.", wait_minutes="The interval in minutes between each message."
-)
-async def talk(interaction: Interaction, topic: Literal["nonsense", "quotes"], wait_minutes: float = 5.0) -> None:
-    context = await create_command_context(interaction, params={"topic": f"talk_{topic}", "wait_minutes": wait_minutes})
-    interval = wait_minutes * 60
-
-    config = get_config()
-    prompt = config.get("PROMPTS", topic)
-
-    if not discord.utils.get(bot.voice_clients, guild=interaction.guild):
-        await interaction.response.send_message(content="I must be in a voice channel before you use this command.")
-        return
-
-    await interaction.response.send_message(content="Starting talk loop.", delete_after=3.0)
-
-    while True:
-
-        # check to see if a voice connection is still active
-        if voice := discord.utils.get(bot.voice_clients, guild=interaction.guild):
-
-            tts, file_path = await speak_and_spell(
-                context=context,
-                prompt=prompt,
-            )
-            source = FFmpegOpusAudio(file_path)
-            _ = voice.play(source)
-
-            # create our file object
-            discord_file = discord.File(fp=file_path, filename=file_path.name)
-
-            await interaction.channel.send(content=tts, file=discord_file)
-            await asyncio.sleep(interval)
-        else:
-            break
-
-    return await context.save()
-
-
-@tree.command(name="rather", description="Play a 'Would You Rather' game with a specified topic.")
-@app_commands.describe(topic="The subject for the generated hypothetical question.")
-async def rather(interaction: Interaction, topic: Literal["normal", "adult", "games", "fitness"] = "normal") -> None:
-    context = await create_command_context(interaction, params={"topic": f"rather_{topic}"})
-    config = get_config()
-    topic = f"rather_{topic}"
-    new_hypothetical_prompt = config.get("PROMPTS", "new_hypothetical")
-
-    await interaction.response.defer()
-
-    tts, file_path = await speak_and_spell(
-        context=context,
-        prompt=new_hypothetical_prompt,
-    )
-
-    # play over a voice channel
-    if voice := discord.utils.get(bot.voice_clients, guild=interaction.guild):
-        source = FFmpegOpusAudio(file_path)
-        _ = voice.play(source)
-
-    # create our file object
-    discord_file = discord.File(file_path, filename=file_path.name)
-
-    await interaction.followup.send(content=tts, file=discord_file)
-
-    return await context.save()
-
-
-@tree.command(name="say", description="Make the bot say a specified text.")
-@app_commands.describe(text_to_speech="The text you want the bot to say.", voice="The OpenAI voice model to use.")
-async def say(
-    interaction: Interaction,
-    text_to_speech: str,
-    voice: Literal["alloy", "ash", "coral", "echo", "fable", "onyx", "nova", "sage", "shimmer"] = "onyx",
-) -> None:
-    context = await create_command_context(interaction, params={"text_to_speech": text_to_speech, "voice": voice})
-    ts = datetime.now().strftime("%Y%m%d%H%M%S")
-    file_name = f"{ts}.wav"
-    voice_client = discord.utils.get(bot.voice_clients, guild=interaction.guild)
-
-    await interaction.response.defer()
-
-    file_path = await generate_speech(
-        context=context,
-        file_name=file_name,
-        tts=text_to_speech,
-        voice=voice,
-    )
-
-    if voice_client:
-        source = FFmpegOpusAudio(file_path)
-        _ = voice_client.play(source)
-
-    # create our file object
-    discord_file = discord.File(fp=file_path, filename=file_path.name)
-
-    await interaction.followup.send(content=text_to_speech, file=discord_file)
-
-    return await context.save()
-
-
-@tree.command(name="image", description="Generate an image using a prompt and a specified model.")
-@app_commands.describe(
-    image_prompt="The prompt used for image generation.",
-    image_model="The OpenAI image model to use.",
-    background="Allows to set transparency for the background of the generated image(s). gpt-image-1 only.",
-)
-async def image(
-    interaction: Interaction,
-    image_prompt: str,
-    image_model: Literal["dall-e-2", "dall-e-3", "gpt-image-1"] = "dall-e-3",
-    background: Literal["transparent", "opaque", "auto"] = "auto",
-) -> None:
-    context = await create_command_context(
-        interaction, params={"prompt": image_prompt, "model": image_model, "background": background}
-    )
-    submission_params = context.params
-
-    await interaction.response.defer()
-
-    openai_client = await get_openai_client(interaction.guild_id)
-
-    # create our embed object
-    embed = Embed(
-        color=10181046,
-        title=f"`{image_model}` Image Generation",
-        description=f"### User Input:\n> {image_prompt}",
-    )
-
-    # gpt-image-1 has some special use cases that don't apply to dall-e-2/3
-    if image_model != "gpt-image-1":
-        _ = submission_params.pop("background")
-        submission_params["response_format"] = "b64_json"
-    else:
-
-        if not check_model_limit(context=context, usage_tracker=usage_tracker):
-
-            await interaction.followup.send(
-                content=f"`{context.params["model"]}` been used too much today. Try again tomorrow!"
-            )
-
-            return
-
-        submission_params["moderation"] = "low"
-
-        # set a footer showing usage information. Will not collide with dall-e-3 below because this is gpt-image-1 only
-        embed.set_footer(
-            text=(
-                f"Used {usage_tracker[interaction.guild_id][image_model]["count"]} "
-                f"out of {usage_tracker[interaction.guild_id][image_model]["limit"]} "
-                f"image generations with {image_model} today."
-            )
-        )
-
-    try:
-        image_response = await openai_client.images.generate(**submission_params)
-    except BadRequestError:
-        await interaction.followup.send(
-            f"Your prompt:\n> {image_prompt}\nProbably violated OpenAI's content policies. Clean up your act."
-        )
-        return
-
-    image_object: Image = image_response.data[0]
-
-    # save the generated image to a file
-    file_name = f"image_{image_response.created}.png"
-    path = content_path(context=context, file_name=file_name)
-    image_bytes = base64.b64decode(image_object.b64_json)
-
-    with open(path, "wb") as file:
-        file.write(image_bytes)
-
-    embed.set_image(url=f"attachment://{file_name}")
-
-    # set the footer text if this is dall-e-3
-    if image_object.revised_prompt:
-        embed.set_footer(text=f"Revised Prompt:\n{image_object.revised_prompt}")
-
-    # attach our file object
-    file_upload = discord.File(fp=path, filename=file_name)
-
-    await interaction.followup.send(file=file_upload, embed=embed)
-
-    return await context.save()
-
-
-@tree.command(name="vision", description="Describe or interpret an image using a prompt.")
-@app_commands.describe(
-    attachment="The image file you want to describe or interpret.",
-    vision_prompt="The prompt to be used when describing the image.",
-)
-async def vision(interaction: Interaction, attachment: discord.Attachment, vision_prompt: str = "") -> None:
-    context = await create_command_context(
-        interaction, params={"vision_prompt": vision_prompt, "attachment": attachment.filename}
-    )
-    config = get_config()
-
-    if not vision_prompt:
-        vision_prompt = config.get("PROMPTS", "vision_prompt", fallback="What is in this image?")
-
-    try:
-        image_url = attachment.url
-    except IndexError:
-        await interaction.response.send_message(
-            "```plaintext\nError: Unable to retrieve the image attachment. Did you attach an image?\n```"
-        )
-        return
-
-    await interaction.response.defer()
-
-    openai_client = await get_openai_client(interaction.guild_id)
-
-    response = await openai_client.responses.create(
-        model=config.get("OPENAI_GENERAL", "vision_model", fallback="gpt-4o"),
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": vision_prompt},
-                    {"type": "input_image", "image_url": image_url},
-                ],
-            }
-        ],
-        max_output_tokens=config.getint("OPENAI_GENERAL", "max_output_tokens", fallback=500),
-    )
-
-    embed = Embed(
-        color=5763719,
-        title="Vision Response",
-        description=f"User Input:\n```{vision_prompt}```",
-    )
-
-    req = Request(
-        url=attachment.url,
-        headers={"User-Agent": USER_AGENT},
-    )
-
-    # Download the image from the URL
-    with urlopen(req) as img_response:
-        image_data = img_response.read()
-        with open(attachment.filename, "wb") as file:
-            file.write(image_data)
-
-    discord_file = discord.File(fp=attachment.filename, filename=attachment.filename)
-
-    embed.set_image(url=f"attachment://{attachment.filename}")
-    embed.set_footer(text=response.output_text)
-
-    await interaction.followup.send(embed=embed, file=discord_file)
-
-    Path(attachment.filename).unlink()
-
-    return await context.save()
-
-
-@tree.command(name="chat", description="Have a conversation with an OpenAI Chat Model, like you would with ChatGPT.")
-@app_commands.describe(
-    chat_prompt="The text of your question or statement that you wan the Chat Model to address.",
-    keep_chatting="Continue the conversation from your last prompt.",
-    chat_model="The OpenAI Chat Model to use.",
-    custom_instructions="Help the Chat Model respond to your prompt the way YOU want it to.",
-)
-async def chat(
-    interaction: Interaction,
-    chat_prompt: str,
-    keep_chatting: Literal["Yes", "No"] = "No",
-    chat_model: Literal[
-        "gpt-3.5-turbo", "gpt-4o-mini", "gpt-4.5-preview", "gpt-4o", "gpt-4.1", "gpt-4.1-mini", "gpt-4.1-nano"
-    ] = "gpt-4o-mini",
-    custom_instructions: Optional[str] = None,
-) -> None:
-
-    if not custom_instructions:
-        config = get_config()
-        custom_instructions = config.get(
-            "OPENAI_INSTRUCTIONS",
-            "chat_helper",
-            fallback="Ensure your response is under 2,000 characters and uses markdown compatible with Discord.",
-        )
-
-    context = await create_command_context(
-        interaction,
-        params={
-            "chat_prompt": chat_prompt,
-            "topic": str(interaction.user.id),
-            "custom_instructions": custom_instructions,
-            "keep_chatting": keep_chatting == "Yes",
-            "model": chat_model,
-        },
-    )
-
-    await interaction.response.defer()
-
-    try:
-        response = await new_response(context=context, prompt=chat_prompt, model=chat_model)
-    except BadRequestError:
-        await interaction.followup.send(
-            f"Your prompt:\n> {chat_prompt}\nProbably violated OpenAI's content policies. Clean up your act."
-        )
-        return
-
-    title = f"🤖 `{chat_model}` Response{' (Continued)' if response.previous_response_id else ''}"
-    embed = Embed(title=title, description=response.output_text, color=1752220)
-
-    await interaction.followup.send(content=f"> {chat_prompt}", embed=embed)
-
-    return await context.save()
-
-
-@bot.event
-async def on_ready():
-
-    await tree.sync()  # Sync slash commands globally
-    print(f"Logged in as {bot.user}")
-
-
-bot.run(os.getenv("DISCORD_BOT_KEY"))
+# pylint: disable=C0116
+"""
+A simple Discord Bot that utilizes the OpenAI API.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import signal
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, Literal, Optional, Set
+
+import discord
+from aiohttp import web
+from discord import Embed, Intents, Interaction, app_commands
+from openai import BadRequestError
+from openai.types import Image
+
+from ai_helpers import (
+    check_model_limit,
+    client_cache_stats,
+    content_dir,
+    decode_b64,
+    describe_image,
+    generate_image,
+    generate_speech,
+    get_settings,
+    new_response,
+    reload_config,
+    save_content,
+)
+from audio_helpers import opus_cache_stats
+from content_store import build_index, content_store_stats, sweep
+from db_utils import (
+    TalkJob,
+    audit_sink,
+    create_command_context,
+    get_command_fingerprint,
+    init_db,
+    save_command_fingerprint,
+)
+from fair_queue import openai_queue_stats, queue_listener
+from metrics import instrument_command, monitor_loop_lag, registry, span, start_metrics_server
+from openai_requests import OpenAIUnavailable, openai_request_stats
+from question_pool import get_question_pool, question_pool_stats
+from speech_cache import speech_cache_stats
+from talk_scheduler import TalkScheduler
+from voice_queue import QUEUE_FULL_NOTE, get_voice_queue, queue_file, queue_speech, voice_queue_stats
+
+logger = logging.getLogger(__name__)
+
+BULK_DELETE_LIMIT = 100
+SHARD_REPORT_INTERVAL = 60.0
+
+SHARD_LATENCY = registry.gauge("discord_bot_shard_latency_seconds", "Gateway heartbeat latency.", ("shard",))
+SHARD_EVENTS = registry.gauge("discord_bot_shard_events_per_second", "Gateway events dispatched.", ("shard",))
+registry.add_stats("openai_client_cache", client_cache_stats)
+registry.add_stats("openai_requests", openai_request_stats)
+registry.add_stats("openai_queue", openai_queue_stats)
+registry.add_stats("speech_cache", speech_cache_stats)
+registry.add_stats("voice_queue", voice_queue_stats)
+registry.add_stats("question_pool", question_pool_stats)
+registry.add_stats("content_store", content_store_stats)
+registry.add_stats("opus_cache", opus_cache_stats)
+
+
+class OpenAIBot(discord.AutoShardedClient):
+    """
+    The bot's Discord client, with our own startup and shutdown work.
+    It runs every shard given to it (all of them by default) in one process; see launcher.py for more processes.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # shard_id -> latest latency and event rate
+        self.shard_stats: Dict[int, Dict[str, float]] = {}
+        self._shard_sequences: Dict[int, int] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._metrics_server: Optional[web.AppRunner] = None
+        # on_ready fires again after every gateway reconnect, but the commands only need syncing once
+        self.commands_synced = False
+
+    async def setup_hook(self) -> None:
+        # bot.run only shuts down cleanly on SIGINT, but docker stop sends SIGTERM; close() flushes the audit buffer
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._close_on_signal)
+        except NotImplementedError:
+            # Windows event loops don't support signal handlers
+            pass
+
+        background = [(self.report_shards(), "shard-report"), (monitor_loop_lag(), "loop-lag")]
+        # every process shares generated_content, so only the one running shard 0 looks after it
+        if get_settings().storage_sweep_minutes > 0 and (self.shard_ids is None or 0 in self.shard_ids):
+            background.append((self.manage_storage(), "content-store"))
+
+        for coro, name in background:
+            task = asyncio.create_task(coro, name=name)
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+        # each process of a launcher.py fleet owns a different lowest shard, so offsetting by it keeps ports apart
+        settings = get_settings()
+        if settings.metrics_port:
+            port = settings.metrics_port + min(self.shard_ids or [0])
+            self._metrics_server = await start_metrics_server(host=settings.metrics_host, port=port)
+
+    def _close_on_signal(self) -> None:
+        task = asyncio.create_task(self.close(), name="sigterm-close")
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def report_shards(self) -> None:
+        """
+        Periodically log each shard's gateway latency and event rate
+        """
+        await self.wait_until_ready()
+        last_report = time.monotonic()
+
+        while not self.is_closed():
+            await asyncio.sleep(SHARD_REPORT_INTERVAL)
+            elapsed, last_report = time.monotonic() - last_report, time.monotonic()
+
+            for shard_id, latency in self.latencies:
+                # the gateway sequence number counts the events dispatched in the shard's current session
+                sequence = self._get_websocket(shard_id=shard_id).sequence or 0
+                previous = self._shard_sequences.get(shard_id, 0)
+                events = sequence - previous if sequence >= previous else sequence
+                self._shard_sequences[shard_id] = sequence
+
+                self.shard_stats[shard_id] = {"latency_ms": latency * 1000, "events_per_second": events / elapsed}
+                SHARD_LATENCY.set(latency, shard=shard_id)
+                SHARD_EVENTS.set(events / elapsed, shard=shard_id)
+                logger.info(
+                    "Shard %s: %.0f ms gateway latency, %.1f events/s",
+                    shard_id,
+                    self.shard_stats[shard_id]["latency_ms"],
+                    self.shard_stats[shard_id]["events_per_second"],
+                )
+
+    async def manage_storage(self) -> None:
+        """
+        Index generated content, then periodically transcode and evict it to stay within the configured limits
+        """
+        await build_index()
+
+        while not self.is_closed():
+            settings = get_settings()
+            try:
+                removed = await sweep(
+                    guild_quota_bytes=settings.storage_guild_quota_bytes,
+                    max_age=timedelta(days=settings.storage_max_age_days) if settings.storage_max_age_days else None,
+                    transcode_after=(
+                        timedelta(days=settings.storage_transcode_after_days)
+                        if settings.storage_transcode_after_days
+                        else None
+                    ),
+                )
+                # content_dir remembers the directories it has created, and some of them are gone now
+                if removed:
+                    content_dir.cache_clear()
+            except Exception:  # pylint: disable=W0718
+                logger.exception("Could not sweep generated content")
+
+            await asyncio.sleep(settings.storage_sweep_minutes * 60)
+
+    async def close(self) -> None:
+        await super().close()
+        # write any buffered command records before the event loop goes away
+        await audit_sink.close()
+        if self._metrics_server:
+            await self._metrics_server.cleanup()
+            self._metrics_server = None
+
+
+# Bot Client
+intents = Intents.default()
+intents.messages = True
+intents.guilds = True
+
+# launcher.py hands each process its slice of the shards; on our own we run them all
+bot = OpenAIBot(
+    intents=intents,
+    shard_count=int(os.environ["SHARD_COUNT"]) if os.getenv("SHARD_COUNT") else None,
+    shard_ids=[int(shard_id) for shard_id in os.environ["SHARD_IDS"].split(",")] if os.getenv("SHARD_IDS") else None,
+)
+tree = discord.app_commands.CommandTree(bot)
+talk_scheduler = TalkScheduler(bot)
+
+# config.ini edits are picked up by mtime automatically; SIGHUP forces an immediate re-read
+if hasattr(signal, "SIGHUP"):
+    signal.signal(signal.SIGHUP, lambda *_: reload_config())
+
+
+def show_queue_position(interaction: Interaction) -> Callable[[Optional[int]], Awaitable[None]]:
+    """
+    Show a deferred command its place in the OpenAI queue, and take the note down once its turn comes
+    """
+    shown = False
+
+    async def report(position: Optional[int]) -> None:
+        nonlocal shown
+        try:
+            if position is not None:
+                await interaction.edit_original_response(
+                    content=f"-# Waiting for OpenAI: {position} request{'' if position == 1 else 's'} ahead of you."
+                    if position
+                    else "-# Waiting for a free OpenAI slot."
+                )
+                shown = True
+            elif shown:
+                await interaction.delete_original_response()
+                shown = False
+        except discord.HTTPException:
+            pass
+
+    return report
+
+
+@tree.error
+async def on_app_command_error(interaction: Interaction, error: app_commands.AppCommandError) -> None:
+    # answer the interaction instead of leaving it deferred ("thinking...") forever
+    original = getattr(error, "original", error)
+
+    if isinstance(original, OpenAIUnavailable):
+        logger.warning("/%s: %s", interaction.command.name if interaction.command else "?", original)
+        content = "OpenAI isn't responding right now."
+        if original.retry_after:
+            content += f" Try again in {math.ceil(original.retry_after)} seconds."
+    else:
+        logger.error("Ignoring exception in command %r", interaction.command, exc_info=error)
+        content = "Something went wrong with that command."
+
+    if interaction.response.is_done():
+        await interaction.followup.send(content=content, ephemeral=True)
+    else:
+        await interaction.response.send_message(content=content, ephemeral=True)
+
+
+@tree.command(name="join", description="Join the voice channel that the user is currently in.")
+@instrument_command
+async def join(interaction: Interaction) -> None:
+    context = await create_command_context(interaction)
+
+    if interaction.user.voice:
+        await interaction.user.voice.channel.connect()
+        await interaction.response.send_message(content="I have joined the voice chat.", delete_after=3.0)
+    else:
+        await interaction.response.send_message(content=f"{interaction.user.name} is not in a voice channel.")
+
+    return await context.save()
+
+
+@tree.command(name="leave", description="Leave the voice channel that the bot is currently in.")
+@instrument_command
+async def leave(interaction: Interaction) -> None:
+    context = await create_command_context(interaction)
+
+    if interaction.guild.voice_client:
+        await talk_scheduler.stop(interaction.guild_id)
+        get_voice_queue(interaction.guild_id).clear()
+        await interaction.guild.voice_client.disconnect()
+        await interaction.response.send_message(content="I have left the voice chat.", delete_after=3.0)
+
+    return await context.save()
+
+
+@tree.command(name="clean", description="Delete messages sent by the bot within a specified timeframe.")
+@app_commands.describe(number_of_minutes="The number of minutes to look back for message deletion.")
+@instrument_command
+async def clean(interaction: Interaction, number_of_minutes: int) -> None:
+    context = await create_command_context(interaction, params={"number_of_minutes": number_of_minutes})
+    settings = get_settings()
+
+    max_clean_minutes = settings.max_clean_minutes
+    if max_clean_minutes < number_of_minutes:
+        await interaction.response.send_message(content=f"Can't clean more than {max_clean_minutes} minutes back.")
+        return
+
+    after_time = datetime.now() - timedelta(minutes=number_of_minutes)
+    started = time.monotonic()
+
+    await interaction.response.send_message(content="Deleting messages...")
+    status = await interaction.original_response()
+
+    # Discord only bulk deletes messages younger than 14 days; leave a little slack for clock skew
+    bulk_cutoff = discord.utils.utcnow() - timedelta(days=14) + timedelta(minutes=5)
+    recent, older = [], []
+
+    async for message in interaction.channel.history(limit=None, after=after_time):
+        if message.author.id == bot.user.id and message.id != status.id:
+            (recent if message.created_at > bulk_cutoff else older).append(message)
+
+    total = len(recent) + len(older)
+    deleted = 0
+
+    # bulk deletes take up to 100 messages per request
+    for start in range(0, len(recent), BULK_DELETE_LIMIT):
+        batch = recent[start : start + BULK_DELETE_LIMIT]
+        try:
+            await interaction.channel.delete_messages(batch)
+        except discord.HTTPException:
+            # bulk delete needs Manage Messages; our own messages can still go one by one
+            older.extend(batch)
+            continue
+        deleted += len(batch)
+        await status.edit(content=f"Deleting messages... {deleted}/{total}")
+
+    # discord.py paces these from the rate limit headers on the delete bucket
+    for message in older:
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+        deleted += 1
+        if deleted % BULK_DELETE_LIMIT == 0:
+            await status.edit(content=f"Deleting messages... {deleted}/{total}")
+
+    await status.edit(content=f"Deleted {deleted} messages in {time.monotonic() - started:.1f} seconds.")
+
+    return await context.save()
+
+
+@tree.command(name="talk", description="Start a loop where the bot talks about a specified topic at regular intervals.")
+@app_commands.describe(
+    topic="The topic the bot will talk about.", wait_minutes="The interval in minutes between each message."
+)
+@instrument_command
+async def talk(interaction: Interaction, topic: Literal["nonsense", "quotes"], wait_minutes: float = 5.0) -> None:
+    context = await create_command_context(interaction, params={"topic": f"talk_{topic}", "wait_minutes": wait_minutes})
+
+    if not (voice := discord.utils.get(bot.voice_clients, guild=interaction.guild)):
+        await interaction.response.send_message(content="I must be in a voice channel before you use this command.")
+        return
+
+    # a guild only ever has one loop; talking again just changes its topic and interval
+    replaced = talk_scheduler.status(interaction.guild_id) is not None
+    await interaction.response.send_message(
+        content="Updating the talk loop." if replaced else "Starting talk loop.", delete_after=3.0
+    )
+
+    await talk_scheduler.start(
+        TalkJob(
+            guild_id=interaction.guild_id,
+            text_channel_id=interaction.channel_id,
+            voice_channel_id=voice.channel.id,
+            topic=topic,
+            interval=wait_minutes * 60,
+            next_run=datetime.now(),
+            user_id=interaction.user.id,
+            user=interaction.user.name,
+        )
+    )
+
+    return await context.save()
+
+
+@tree.command(name="talk_stop", description="Stop the talk loop.")
+@instrument_command
+async def talk_stop(interaction: Interaction) -> None:
+    context = await create_command_context(interaction)
+
+    if await talk_scheduler.stop(interaction.guild_id):
+        await interaction.response.send_message(content="Stopped the talk loop.", delete_after=3.0)
+    else:
+        await interaction.response.send_message(content="There's no talk loop running.", delete_after=3.0)
+
+    return await context.save()
+
+
+@tree.command(name="talk_status", description="Show the talk loop's topic, interval and next message.")
+@instrument_command
+async def talk_status(interaction: Interaction) -> None:
+    context = await create_command_context(interaction)
+
+    if job := talk_scheduler.status(interaction.guild_id):
+        await interaction.response.send_message(
+            content=(
+                f"Talking about **{job.topic}** every {job.interval / 60:g} minutes. "
+                f"Next message {discord.utils.format_dt(job.next_run, style='R')}."
+            )
+        )
+    else:
+        await interaction.response.send_message(content="There's no talk loop running.")
+
+    return await context.save()
+
+
+@tree.command(name="rather", description="Play a 'Would You Rather' game with a specified topic.")
+@app_commands.describe(topic="The subject for the generated hypothetical question.")
+@instrument_command
+async def rather(interaction: Interaction, topic: Literal["normal", "adult", "games", "fitness"] = "normal") -> None:
+    context = await create_command_context(interaction, params={"topic": f"rather_{topic}"})
+    pool = get_question_pool(guild_id=interaction.guild_id, topic=f"rather_{topic}")
+
+    with span("defer"):
+        await interaction.response.defer()
+    queue_listener.set(show_queue_position(interaction))
+
+    voice = discord.utils.get(bot.voice_clients, guild=interaction.guild)
+    queued = True
+
+    if question := await pool.take(context=context):
+        tts, file_path = question
+        if voice:
+            queued = queue_file(voice_client=voice, file_path=file_path)
+    else:
+        # the pool is empty, so play over a voice channel as the speech is generated
+        stream = None
+        if voice:
+            stream = queue_speech(voice_client=voice)
+            queued = stream is not None
+
+        tts, file_path = await pool.generate(stream=stream)
+
+    # top the pool back up while people argue about this one
+    pool.refill()
+
+    # create our file object; a speech cache hit is named after its hash, so don't upload it under that
+    ts = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    discord_file = discord.File(file_path, filename=f"would_you_rather_{ts}{file_path.suffix}")
+
+    if not queued:
+        tts = f"{tts}\n{QUEUE_FULL_NOTE}"
+
+    with span("upload"):
+        await interaction.followup.send(content=tts, file=discord_file)
+
+    return await context.save()
+
+
+@tree.command(name="say", description="Make the bot say a specified text.")
+@app_commands.describe(text_to_speech="The text you want the bot to say.", voice="The OpenAI voice model to use.")
+@instrument_command
+async def say(
+    interaction: Interaction,
+    text_to_speech: str,
+    voice: Literal["alloy", "ash", "coral", "echo", "fable", "onyx", "nova", "sage", "shimmer"] = "onyx",
+) -> None:
+    context = await create_command_context(interaction, params={"text_to_speech": text_to_speech, "voice": voice})
+    ts = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    file_name = f"{ts}.wav"
+    voice_client = discord.utils.get(bot.voice_clients, guild=interaction.guild)
+
+    with span("defer"):
+        await interaction.response.defer()
+    queue_listener.set(show_queue_position(interaction))
+
+    stream = None
+    if voice_client:
+        stream = queue_speech(voice_client=voice_client)
+
+    file_path = await generate_speech(
+        context=context,
+        file_name=file_name,
+        tts=text_to_speech,
+        voice=voice,
+        stream=stream,
+    )
+
+    # create our file object
+    discord_file = discord.File(fp=file_path, filename=file_name)
+
+    content = f"{text_to_speech}\n{QUEUE_FULL_NOTE}" if voice_client and not stream else text_to_speech
+    with span("upload"):
+        await interaction.followup.send(content=content, file=discord_file)
+
+    return await context.save()
+
+
+@tree.command(name="image", description="Generate an image using a prompt and a specified model.")
+@app_commands.describe(
+    image_prompt="The prompt used for image generation.",
+    image_model="The OpenAI image model to use.",
+    background="Allows to set transparency for the background of the generated image(s). gpt-image-1 only.",
+)
+@instrument_command
+async def image(
+    interaction: Interaction,
+    image_prompt: str,
+    image_model: Literal["dall-e-2", "dall-e-3", "gpt-image-1"] = "dall-e-3",
+    background: Literal["transparent", "opaque", "auto"] = "auto",
+) -> None:
+    context = await create_command_context(
+        interaction, params={"prompt": image_prompt, "model": image_model, "background": background}
+    )
+    submission_params = context.params
+
+    with span("defer"):
+        await interaction.response.defer()
+    queue_listener.set(show_queue_position(interaction))
+
+    # create our embed object
+    embed = Embed(
+        color=10181046,
+        title=f"`{image_model}` Image Generation",
+        description=f"### User Input:\n> {image_prompt}",
+    )
+
+    # gpt-image-1 has some special use cases that don't apply to dall-e-2/3
+    if image_model != "gpt-image-1":
+        _ = submission_params.pop("background")
+        submission_params["response_format"] = "b64_json"
+    else:
+
+        allowed, used, limit = await check_model_limit(context=context)
+
+        if not allowed:
+
+            await interaction.followup.send(content=f"`{image_model}` been used too much today. Try again tomorrow!")
+
+            return
+
+        submission_params["moderation"] = "low"
+
+        # set a footer showing usage information. Will not collide with dall-e-3 below because this is gpt-image-1 only
+        if limit:
+            embed.set_footer(text=f"Used {used} out of {limit} image generations with {image_model} today.")
+
+    try:
+        image_response = await generate_image(context=context, **submission_params)
+    except BadRequestError:
+        await interaction.followup.send(
+            f"Your prompt:\n> {image_prompt}\nProbably violated OpenAI's content policies. Clean up your act."
+        )
+        return
+
+    image_object: Image = image_response.data[0]
+
+    # save the generated image to a file in the background while we upload it straight from memory
+    file_name = f"image_{image_response.created}.png"
+    image_bytes = await decode_b64(image_object.b64_json)
+    saved = asyncio.create_task(save_content(context=context, file_name=file_name, data=image_bytes))
+
+    embed.set_image(url=f"attachment://{file_name}")
+
+    # set the footer text if this is dall-e-3
+    if image_object.revised_prompt:
+        embed.set_footer(text=f"Revised Prompt:\n{image_object.revised_prompt}")
+
+    # attach our file object
+    file_upload = discord.File(fp=BytesIO(image_bytes), filename=file_name)
+
+    with span("upload"):
+        await interaction.followup.send(file=file_upload, embed=embed)
+    await saved
+
+    return await context.save()
+
+
+@tree.command(name="vision", description="Describe or interpret an image using a prompt.")
+@app_commands.describe(
+    attachment="The image file you want to describe or interpret.",
+    vision_prompt="The prompt to be used when describing the image.",
+)
+@instrument_command
+async def vision(interaction: Interaction, attachment: discord.Attachment, vision_prompt: str = "") -> None:
+    context = await create_command_context(
+        interaction, params={"vision_prompt": vision_prompt, "attachment": attachment.filename}
+    )
+    settings = get_settings()
+
+    if not vision_prompt:
+        vision_prompt = settings.prompts.get("vision_prompt", "What is in this image?")
+
+    try:
+        image_url = attachment.url
+    except IndexError:
+        await interaction.response.send_message(
+            "```plaintext\nError: Unable to retrieve the image attachment. Did you attach an image?\n```"
+        )
+        return
+
+    if attachment.size > settings.max_attachment_bytes:
+        await interaction.response.send_message(
+            f"That image is too big. Keep attachments under {settings.max_attachment_bytes // (1024 * 1024)} MB."
+        )
+        return
+
+    with span("defer"):
+        await interaction.response.defer()
+    queue_listener.set(show_queue_position(interaction))
+
+    # fetch the image for our embed over the bot's own HTTP session while OpenAI looks at it
+    image_data, response = await asyncio.gather(
+        attachment.read(),
+        describe_image(context=context, prompt=vision_prompt, image_url=image_url),
+    )
+
+    embed = Embed(
+        color=5763719,
+        title="Vision Response",
+        description=f"User Input:\n```{vision_prompt}```",
+    )
+
+    discord_file = discord.File(fp=BytesIO(image_data), filename=attachment.filename)
+
+    embed.set_image(url=f"attachment://{attachment.filename}")
+    embed.set_footer(text=response.output_text)
+
+    with span("upload"):
+        await interaction.followup.send(embed=embed, file=discord_file)
+
+    return await context.save()
+
+
+@tree.command(name="chat", description="Have a conversation with an OpenAI Chat Model, like you would with ChatGPT.")
+@app_commands.describe(
+    chat_prompt="The text of your question or statement that you wan the Chat Model to address.",
+    keep_chatting="Continue the conversation from your last prompt.",
+    chat_model="The OpenAI Chat Model to use.",
+    custom_instructions="Help the Chat Model respond to your prompt the way YOU want it to.",
+)
+@instrument_command
+async def chat(
+    interaction: Interaction,
+    chat_prompt: str,
+    keep_chatting: Literal["Yes", "No"] = "No",
+    chat_model: Literal[
+        "gpt-3.5-turbo", "gpt-4o-mini", "gpt-4.5-preview", "gpt-4o", "gpt-4.1", "gpt-4.1-mini", "gpt-4.1-nano"
+    ] = "gpt-4o-mini",
+    custom_instructions: Optional[str] = None,
+) -> None:
+
+    if not custom_instructions:
+        custom_instructions = get_settings().instructions.get(
+            "chat_helper",
+            "Ensure your response is under 2,000 characters and uses markdown compatible with Discord.",
+        )
+
+    context = await create_command_context(
+        interaction,
+        params={
+            "chat_prompt": chat_prompt,
+            "topic": str(interaction.user.id),
+            "custom_instructions": custom_instructions,
+            "keep_chatting": keep_chatting == "Yes",
+            "model": chat_model,
+        },
+    )
+
+    with span("defer"):
+        await interaction.response.defer()
+    queue_listener.set(show_queue_position(interaction))
+
+    embed = Embed(title=f"🤖 `{chat_model}` Response", color=1752220)
+    edit_interval = get_settings().stream_edit_interval
+    message: Optional[discord.WebhookMessage] = None
+    last_edit = 0.0
+
+    # send the first delta right away, then batch the rest so we stay under Discord's edit rate limit
+    async def show_text(text: str) -> None:
+        nonlocal message, last_edit
+        if time.monotonic() - last_edit < edit_interval:
+            return
+        last_edit = time.monotonic()
+        embed.description = f"{text} …"
+        if message:
+            await message.edit(embed=embed)
+        else:
+            message = await interaction.followup.send(content=f"> {chat_prompt}", embed=embed, wait=True)
+
+    try:
+        response = await new_response(context=context, prompt=chat_prompt, model=chat_model, on_text=show_text)
+    except Exception as error:  # pylint: disable=W0718
+        # don't leave a half-streamed answer looking like it's still being written
+        if message:
+            partial = (embed.description or "").removesuffix(" …")
+            embed.description = f"{partial}\n\n-# The response stopped early because of an error."
+            embed.color = 15548997
+            try:
+                await message.edit(embed=embed)
+            except discord.HTTPException:
+                logger.warning("Could not mark the interrupted /chat response in guild %s", interaction.guild_id)
+
+        if not isinstance(error, BadRequestError):
+            raise
+        await interaction.followup.send(
+            f"Your prompt:\n> {chat_prompt}\nProbably violated OpenAI's content policies. Clean up your act."
+        )
+        return
+
+    usage = context.params["usage"]
+    embed.title = f"🤖 `{chat_model}` Response{' (Continued)' if usage['turn'] > 1 else ''}"
+    embed.description = response.output_text
+    embed.set_footer(
+        text=(
+            f"Turn {usage['turn']} · {usage['input_tokens']:,} in / {usage['output_tokens']:,} out tokens"
+            f" · {usage['latency']:.1f}s{' · earlier turns summarized' if 'compaction_tokens' in usage else ''}"
+        )
+    )
+
+    with span("upload"):
+        if message:
+            await message.edit(embed=embed)
+        else:
+            await interaction.followup.send(content=f"> {chat_prompt}", embed=embed)
+
+    return await context.save()
+
+
+def command_fingerprint(guild: Optional[discord.abc.Snowflake] = None) -> str:
+    """
+    Hash the slash command definitions that a sync would send to Discord
+    """
+    commands = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)), key=lambda c: c["name"])
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()
+
+
+async def sync_commands() -> None:
+    """
+    Sync the slash commands globally, or to the dev guild if one is configured,
+    skipping the (slow, rate-limited) sync when they haven't changed since the last one
+    """
+    dev_guild_id = get_settings().dev_guild_id
+    guild = discord.Object(id=dev_guild_id) if dev_guild_id else None
+    if guild:
+        tree.copy_global_to(guild=guild)
+
+    scope = f"{bot.application_id}:{f'guild_{dev_guild_id}' if guild else 'global'}"
+    fingerprint = command_fingerprint(guild=guild)
+    if await get_command_fingerprint(scope=scope) == fingerprint:
+        logger.info("Slash commands are unchanged since the last sync to %s", scope)
+        return
+
+    synced = await tree.sync(guild=guild)
+    await save_command_fingerprint(scope=scope, fingerprint=fingerprint)
+    logger.info("Synced %s slash commands to %s", len(synced), scope)
+
+
+@bot.event
+async def on_ready():
+
+    # only one process needs to sync slash commands when shards are split across processes
+    if not bot.commands_synced and (bot.shard_ids is None or 0 in bot.shard_ids):
+        bot.commands_synced = True
+        try:
+            await sync_commands()
+        except Exception:  # pylint: disable=W0718
+            # a failed sync (Discord, or the fingerprint table) mustn't keep talk loops from resuming;
+            # try again on the next reconnect
+            bot.commands_synced = False
+            logger.exception("Could not sync slash commands")
+    await talk_scheduler.load()
+    logger.info("Logged in as %s (shards %s)", bot.user, bot.shard_ids or list(range(bot.shard_count or 1)))
+
+
+if __name__ == "__main__":
+    init_db()
+    bot.run(os.getenv("DISCORD_BOT_KEY"), root_logger=True)
@@ -0,0 +1,360 @@
+"""
+Helper functions for getting generated speech into a Discord voice channel
+"""
+
+import array
+import asyncio
+import io
+import queue
+import re
+import sys
+import threading
+import wave
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from discord import AudioSource, FFmpegOpusAudio, opus
+from discord.opus import OPUS_SILENCE
+
+# the Speech API's "pcm" format: raw 24kHz, 16-bit, mono, little-endian samples
+PCM_SAMPLE_RATE = 24000
+PCM_SAMPLE_WIDTH = 2
+PCM_CHANNELS = 1
+# discord.py plays one 20ms Opus packet at a time, which is this much Speech API audio
+PCM_FRAME_BYTES = PCM_SAMPLE_RATE // 50 * PCM_SAMPLE_WIDTH * PCM_CHANNELS
+
+# how long the FFmpeg pipe waits for more speech before writing a frame of silence instead
+UNDERRUN_WAIT = 0.02
+
+# kbps; speech doesn't need discord.py's default of 128
+OPUS_BITRATE = 64
+OPUS_CACHE_BYTES = 64 * 1024 * 1024
+
+# sentences shorter than this are merged into the next one so each speech request is worth its round trip
+MIN_SPEECH_CHUNK_CHARS = 40
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+# cache key -> the clip's Opus packets, least recently used first
+_opus_cache: "OrderedDict[str, List[bytes]]" = OrderedDict()
+_opus_cache_lock = threading.Lock()
+opus_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+class SpeechStream(io.RawIOBase):
+    """
+    A pipe between the event loop, which feeds speech bytes as they arrive, and the audio player's thread,
+    which reads them. read() blocks until data is available or finish() has been called; read_available()
+    doesn't, so a player can fill gaps with silence.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: "queue.SimpleQueue[bytes]" = queue.SimpleQueue()
+        self._buffer = b""
+        self._eof = False
+        # set on the event loop once the first audio (or the end) has arrived, so playback can wait for it
+        self.ready = asyncio.Event()
+        # the speech cache key of the audio being fed, set before the first chunk so the player can reuse
+        # or remember the clip's encoded packets. Cleared if the audio is cut short.
+        self.cache_key: Optional[str] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def feed(self, data: bytes) -> None:
+        """
+        Hand a chunk of PCM audio to the reader
+        """
+        if data:
+            self._chunks.put(data)
+            self.ready.set()
+
+    def finish(self) -> None:
+        """
+        Signal that no more audio is coming
+        """
+        self._chunks.put(b"")
+        self.ready.set()
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer and not self._eof:
+            chunk = self._chunks.get()
+            if not chunk:
+                self._eof = True
+            self._buffer += chunk
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read_available(self, size: int, timeout: float = 0.0) -> Optional[bytes]:
+        """
+        Return up to size bytes, b"" at the end of the stream, or None if nothing arrived within timeout seconds
+        """
+        if not self._buffer and not self._eof:
+            try:
+                chunk = self._chunks.get(timeout=timeout) if timeout > 0 else self._chunks.get_nowait()
+            except queue.Empty:
+                return None
+            if not chunk:
+                self._eof = True
+            self._buffer += chunk
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class PacedSpeech(io.RawIOBase):
+    """
+    Hands FFmpeg a SpeechStream's audio, writing silence while the next sentence is still being synthesized
+    so the player never has to wait on FFmpeg mid-clip
+    """
+
+    def __init__(self, stream: SpeechStream) -> None:
+        super().__init__()
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = PCM_FRAME_BYTES
+        data = self._stream.read_available(size, timeout=UNDERRUN_WAIT)
+        return bytes(PCM_FRAME_BYTES) if data is None else data
+
+
+def get_cached_opus(key: str) -> Optional[List[bytes]]:
+    """
+    Return a clip's cached Opus packets, if it has been played before
+    """
+    with _opus_cache_lock:
+        packets = _opus_cache.get(key)
+        if packets is None:
+            opus_cache_stats["misses"] += 1
+            return None
+
+        opus_cache_stats["hits"] += 1
+        _opus_cache.move_to_end(key)
+        return packets
+
+
+def cache_opus(key: str, packets: List[bytes], max_bytes: int = OPUS_CACHE_BYTES) -> None:
+    """
+    Remember a clip's Opus packets, evicting the least recently played clips past max_bytes
+    """
+    with _opus_cache_lock:
+        if old_packets := _opus_cache.pop(key, None):
+            opus_cache_stats["bytes"] -= sum(map(len, old_packets))
+
+        _opus_cache[key] = packets
+        opus_cache_stats["bytes"] += sum(map(len, packets))
+
+        while opus_cache_stats["bytes"] > max_bytes and len(_opus_cache) > 1:
+            _, old_packets = _opus_cache.popitem(last=False)
+            opus_cache_stats["bytes"] -= sum(map(len, old_packets))
+            opus_cache_stats["evictions"] += 1
+
+
+@lru_cache(maxsize=1)
+def opus_available() -> bool:
+    """
+    Whether libopus can be loaded, so speech can be encoded in process instead of by FFmpeg
+    """
+    try:
+        opus.Encoder()
+    except opus.OpusNotLoaded:
+        return False
+    return True
+
+
+def upsample_pcm(data: bytes, previous: int = 0) -> Tuple[bytes, int]:
+    """
+    Turn Speech API PCM (24kHz mono) into what Discord's Opus encoder takes (48kHz stereo), filling in every
+    other sample halfway between its neighbours. Returns the audio and the last input sample, for the next call.
+    """
+    samples = array.array("h", data)
+    if not samples:
+        return b"", previous
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    halfway = array.array("h", [(a + b) >> 1 for a, b in zip((previous, *samples[:-1]), samples)])
+    upsampled = array.array("h", bytes(len(samples) * 8))
+    upsampled[0::4] = halfway
+    upsampled[1::4] = halfway
+    upsampled[2::4] = samples
+    upsampled[3::4] = samples
+
+    last = samples[-1]
+    if sys.byteorder == "big":
+        upsampled.byteswap()
+    return upsampled.tobytes(), last
+
+
+class OpusPackets(AudioSource):
+    """
+    Plays Opus packets that were encoded earlier
+    """
+
+    def __init__(self, packets: List[bytes]) -> None:
+        self._packets = iter(packets)
+
+    def read(self) -> bytes:
+        return next(self._packets, b"")
+
+    def is_opus(self) -> bool:
+        return True
+
+
+class PCMOpusAudio(AudioSource):
+    """
+    Encodes Speech API PCM from a SpeechStream or WAV file into Opus in process, one 20ms packet per read on the
+    player's thread. A clip that plays to the end has its packets cached, and a cached clip is replayed as is.
+    """
+
+    def __init__(self, speech: Union[SpeechStream, wave.Wave_read], cache_key: Optional[str] = None) -> None:
+        self._speech = speech
+        self._cache_key = cache_key
+        self._encoder = opus.Encoder(bitrate=OPUS_BITRATE, signal_type="voice")
+        self._packets: List[bytes] = []
+        self._cached: Optional[Iterator[bytes]] = None
+        self._started = False
+        self._previous = 0
+        self._pending = b""
+
+    def _read_frame(self) -> Optional[bytes]:
+        # None means a stream hasn't delivered a whole frame yet
+        if isinstance(self._speech, wave.Wave_read):
+            return self._speech.readframes(PCM_FRAME_BYTES // PCM_SAMPLE_WIDTH)
+
+        while len(self._pending) < PCM_FRAME_BYTES:
+            data = self._speech.read_available(PCM_FRAME_BYTES - len(self._pending))
+            if data is None:
+                return None
+            if not data:
+                break
+            self._pending += data
+
+        frame, self._pending = self._pending, b""
+        return frame
+
+    def _key(self) -> Optional[str]:
+        return self._speech.cache_key if isinstance(self._speech, SpeechStream) else self._cache_key
+
+    def read(self) -> bytes:
+        if self._cached is not None:
+            return next(self._cached, b"")
+
+        frame = self._read_frame()
+
+        # the player's clock keeps running while the next sentence is synthesized, so fill the gap with silence
+        # instead of blocking and having the player rush to catch up afterwards. Silence isn't cached.
+        if frame is None:
+            return OPUS_SILENCE
+
+        # a stream's key is set before its first chunk, so it's known once the first frame is in.
+        # files were already looked up by speech_source
+        if not self._started:
+            self._started = True
+            if isinstance(self._speech, SpeechStream) and (key := self._key()) and (packets := get_cached_opus(key)):
+                self._cached = iter(packets)
+                return next(self._cached, b"")
+
+        if not frame:
+            if (key := self._key()) and self._packets:
+                cache_opus(key, self._packets)
+                self._packets = []
+            return b""
+
+        pcm, self._previous = upsample_pcm(frame.ljust(PCM_FRAME_BYTES, b"\0"), self._previous)
+        packet = self._encoder.encode(pcm, opus.Encoder.SAMPLES_PER_FRAME)
+        self._packets.append(packet)
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        if isinstance(self._speech, wave.Wave_read):
+            self._speech.close()
+
+
+def ffmpeg_source(speech: Union[SpeechStream, Path]) -> FFmpegOpusAudio:
+    """
+    Build a source that has FFmpeg encode a live speech stream or any audio file
+    """
+    if isinstance(speech, SpeechStream):
+        return FFmpegOpusAudio(
+            PacedSpeech(speech),
+            pipe=True,
+            before_options=f"-f s16le -ar {PCM_SAMPLE_RATE} -ac {PCM_CHANNELS}",
+        )
+
+    return FFmpegOpusAudio(speech)
+
+
+def _open_speech_wav(file_path: Path) -> Optional[wave.Wave_read]:
+    # only WAVs of Speech API PCM can skip FFmpeg
+    try:
+        wav_file = wave.open(str(file_path), "rb")
+    except (wave.Error, EOFError, OSError):
+        return None
+
+    if (wav_file.getframerate(), wav_file.getsampwidth(), wav_file.getnchannels()) != (
+        PCM_SAMPLE_RATE,
+        PCM_SAMPLE_WIDTH,
+        PCM_CHANNELS,
+    ):
+        wav_file.close()
+        return None
+
+    return wav_file
+
+
+def speech_source(speech: Union[SpeechStream, Path]) -> AudioSource:
+    """
+    Build a playable source from either a live speech stream or a finished audio file.
+    Speech API audio is encoded to Opus in process when libopus is available; anything else goes through FFmpeg.
+    """
+    if not opus_available():
+        return ffmpeg_source(speech)
+
+    if isinstance(speech, SpeechStream):
+        return PCMOpusAudio(speech)
+
+    cache_key = f"{speech.resolve()}:{speech.stat().st_mtime_ns}"
+    if packets := get_cached_opus(cache_key):
+        return OpusPackets(packets)
+
+    if wav_file := _open_speech_wav(speech):
+        return PCMOpusAudio(wav_file, cache_key=cache_key)
+
+    return ffmpeg_source(speech)
+
+
+def read_pcm(file_path: Path) -> bytes:
+    """
+    Read the raw PCM frames back out of a WAV file
+    """
+    with wave.open(str(file_path), "rb") as wav_file:
+        return wav_file.readframes(wav_file.getnframes())
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Split text at sentence boundaries into chunks that can be synthesized independently
+    """
+    chunks: List[str] = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        if chunks and len(chunks[-1]) < MIN_SPEECH_CHUNK_CHARS:
+            chunks[-1] = f"{chunks[-1]} {sentence}"
+        else:
+            chunks.append(sentence)
+
+    return chunks
@@ -0,0 +1,1118 @@
+"""
+Drive the bot's command handlers offline, against stand-in Discord objects and a mock OpenAI server,
+and report throughput, latency percentiles, event loop lag and memory for each scenario.
+The playback scenario instead compares the CPU it takes to turn a minute of speech into Opus packets
+with FFmpeg, with the in-process encoder, and from the encoded packet cache. The tts scenario compares
+time to first audio and total time of sentence-chunked speech against one request per text, and
+chat_table grows the Chat table step by step and times a chat turn's reads and writes at each size.
+
+    python benchmark.py
+    python benchmark.py chat say --commands 100 --concurrency 10 --latency-ms 300 --error-rate 0.05
+    python benchmark.py playback --playback-seconds 120 --clip-seconds 3
+    python benchmark.py chat_table --chat-rows 2000000 --commands 500
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cryptography.fernet import Fernet
+
+import mock_openai
+
+REPO_DIR = Path(__file__).resolve().parent
+LAG_INTERVAL = 0.01
+CHAT_TABLE_BATCH = 10000
+CHAT_TABLE_GUILDS = 5000
+RSS_SAMPLE_EVERY = 10
+DRAIN_TIMEOUT = 60.0
+
+# 20ms of the Speech API's 24kHz, 16-bit mono PCM, the size of one voice frame
+PCM_FRAME_BYTES = 960
+
+LONG_TEXT = (
+    "Would you rather fight one horse sized duck or a hundred duck sized horses? "
+    "Think carefully, because the ducks have been training for this moment their whole lives. "
+    "The horses, on the other hand, are small but there are a great many of them."
+)
+
+# the tables as the bot first created them, so every run also checks that init_db() migrates an old database
+BASELINE_SCHEMA = """
+CREATE TABLE commandcontext (
+    id INTEGER NOT NULL, guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, user VARCHAR NOT NULL,
+    command_name VARCHAR NOT NULL, params JSON, timestamp DATETIME NOT NULL, PRIMARY KEY (id)
+);
+CREATE INDEX ix_commandcontext_user_id ON commandcontext (user_id);
+CREATE INDEX ix_commandcontext_guild_id ON commandcontext (guild_id);
+CREATE TABLE "key" (
+    guild_id INTEGER NOT NULL, guild_name VARCHAR NOT NULL, api_key VARCHAR NOT NULL, PRIMARY KEY (guild_id)
+);
+CREATE TABLE chat (
+    response_id VARCHAR NOT NULL, topic VARCHAR NOT NULL, guild_id INTEGER NOT NULL, updated DATETIME NOT NULL,
+    PRIMARY KEY (response_id)
+);
+INSERT INTO chat VALUES ('resp_old', 'baseline', 1, '2024-01-01 00:00:00.000000');
+INSERT INTO chat VALUES ('resp_new', 'baseline', 1, '2024-01-02 00:00:00.000000');
+"""
+
+logger = logging.getLogger("benchmark")
+
+
+@dataclass
+class Scenario:
+    """
+    A command and the arguments to call it with for the i-th invocation
+    """
+
+    command: str
+    make_kwargs: Callable[[int], Dict[str, Any]]
+
+
+class FakeAttachment:
+    """
+    Stands in for discord.Attachment
+    """
+
+    def __init__(self, size: int = 256 * 1024) -> None:
+        self.filename = "benchmark.png"
+        self.url = "https://cdn.example.com/benchmark.png"
+        self.size = size
+        self._data = random.randbytes(size)
+
+    async def read(self) -> bytes:
+        """
+        Return the attachment's bytes
+        """
+        return self._data
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "chat": Scenario("chat", lambda i: {"chat_prompt": f"Question {i}: what's the best pizza topping?"}),
+    "chat_chained": Scenario("chat", lambda i: {"chat_prompt": f"And number {i}?", "keep_chatting": "Yes"}),
+    "rather": Scenario("rather", lambda i: {"topic": "normal"}),
+    "say": Scenario("say", lambda i: {"text_to_speech": f"{LONG_TEXT} This was number {i}."}),
+    "say_cached": Scenario("say", lambda i: {"text_to_speech": "Would you rather?"}),
+    "image": Scenario("image", lambda i: {"image_prompt": f"A duck sized horse, take {i}"}),
+    "vision": Scenario("vision", lambda i: {"attachment": FakeAttachment(), "vision_prompt": "What is this?"}),
+}
+MIXED = ("chat", "rather", "say", "image", "vision")
+# scenarios that aren't a single command repeated, each with its own table
+EXTRA_SCENARIOS = ("mixed", "talk", "tts", "chat_table", "playback")
+
+
+@dataclass
+class CommandTiming:
+    """
+    When one command started, first showed the user something, and returned
+    """
+
+    started: float = field(default_factory=time.perf_counter)
+    first_output: Optional[float] = None
+    finished: Optional[float] = None
+
+    def output(self) -> None:
+        """
+        Note that the user saw something
+        """
+        if self.first_output is None:
+            self.first_output = time.perf_counter()
+
+
+class FakeMessage:
+    """
+    Stands in for the messages the bot edits
+    """
+
+    async def edit(self, **_kwargs: Any) -> "FakeMessage":
+        """
+        Accept an edit
+        """
+        return self
+
+    async def delete(self, **_kwargs: Any) -> None:
+        """
+        Accept a delete
+        """
+
+
+def _close_file(kwargs: Dict[str, Any]) -> None:
+    if file := kwargs.get("file"):
+        file.close()
+
+
+class FakeResponse:
+    """
+    Stands in for discord.InteractionResponse
+    """
+
+    def __init__(self, timing: CommandTiming) -> None:
+        self.timing = timing
+        self._done = False
+
+    def is_done(self) -> bool:
+        """
+        Whether the interaction has been answered or deferred
+        """
+        return self._done
+
+    async def defer(self, **_kwargs: Any) -> None:
+        """
+        Defer the interaction
+        """
+        self._done = True
+
+    async def send_message(self, content: Optional[str] = None, **kwargs: Any) -> None:
+        """
+        Answer the interaction
+        """
+        self._done = True
+        self.timing.output()
+        _close_file(kwargs)
+
+
+class FakeFollowup:
+    """
+    Stands in for the interaction's followup webhook
+    """
+
+    def __init__(self, timing: CommandTiming) -> None:
+        self.timing = timing
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        """
+        Send a followup message
+        """
+        self.timing.output()
+        _close_file(kwargs)
+        return FakeMessage()
+
+
+class FakeChannel:
+    """
+    Stands in for a text channel, remembering when each message arrived
+    """
+
+    def __init__(self, channel_id: int) -> None:
+        self.id = channel_id
+        self.sent: List[float] = []
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        """
+        Send a message
+        """
+        self.sent.append(time.perf_counter())
+        _close_file(kwargs)
+        return FakeMessage()
+
+
+class FakeVoiceClient:
+    """
+    Stands in for discord.VoiceClient. Playing a source reads all of its frames on a thread,
+    as fast as possible or in real time, and records how long the first frame took.
+    """
+
+    def __init__(self, guild: "FakeGuild", realtime: bool, audio_starts: List[float]) -> None:
+        self.guild = guild
+        self.channel = SimpleNamespace(id=guild.id * 10 + 2)
+        self.realtime = realtime
+        self.audio_starts = audio_starts
+        self.frames = 0
+
+    def is_connected(self) -> bool:
+        """
+        Always connected
+        """
+        return True
+
+    def play(self, source: Any, after: Callable[[Optional[Exception]], None]) -> None:
+        """
+        Start draining a source
+        """
+        threading.Thread(target=self._drain, args=(source, after), daemon=True).start()
+
+    def _drain(self, source: Any, after: Callable[[Optional[Exception]], None]) -> None:
+        started = time.perf_counter()
+        error = None
+        try:
+            while source.read():
+                if started:
+                    self.audio_starts.append(time.perf_counter() - started)
+                    started = 0.0
+                self.frames += 1
+                if self.realtime:
+                    time.sleep(0.02)
+        except Exception as exception:  # pylint: disable=W0718
+            error = exception
+        finally:
+            source.cleanup()
+            after(error)
+
+
+class FakeGuild:
+    """
+    Stands in for discord.Guild
+    """
+
+    def __init__(self, guild_id: int, realtime: bool, audio_starts: List[float]) -> None:
+        self.id = guild_id
+        self.name = f"Benchmark {guild_id}"
+        self.text_channel = FakeChannel(guild_id * 10 + 1)
+        self.voice_client = FakeVoiceClient(guild=self, realtime=realtime, audio_starts=audio_starts)
+
+
+class FakeBot:
+    """
+    Stands in for the parts of the bot the talk scheduler looks things up in
+    """
+
+    def __init__(self, guilds: List[FakeGuild]) -> None:
+        self.guilds = {guild.id: guild for guild in guilds}
+        self.channels = {guild.text_channel.id: guild.text_channel for guild in guilds}
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        """
+        Look a guild up by id
+        """
+        return self.guilds.get(guild_id)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        """
+        Look a channel up by id
+        """
+        return self.channels.get(channel_id)
+
+
+class FakeInteraction:
+    """
+    Stands in for discord.Interaction
+    """
+
+    def __init__(self, command_name: str, guild: FakeGuild, user_id: int, timing: CommandTiming) -> None:
+        self.command = SimpleNamespace(name=command_name)
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel_id = guild.text_channel.id
+        self.user = SimpleNamespace(id=user_id, name=f"user{user_id}", voice=None)
+        self.response = FakeResponse(timing)
+        self.followup = FakeFollowup(timing)
+
+    async def edit_original_response(self, **_kwargs: Any) -> FakeMessage:
+        """
+        Edit the deferred response
+        """
+        return FakeMessage()
+
+    async def delete_original_response(self) -> None:
+        """
+        Delete the deferred response
+        """
+
+
+class RawPCMSource:
+    """
+    Reads 20ms PCM frames straight from a speech stream or WAV file, for machines without FFmpeg
+    """
+
+    def __init__(self, speech: Any) -> None:
+        self._wav = wave.open(str(speech), "rb") if isinstance(speech, Path) else None
+        self._stream = speech
+
+    def read(self) -> bytes:
+        """
+        Return the next frame, or b"" at the end
+        """
+        if self._wav:
+            return self._wav.readframes(PCM_FRAME_BYTES // 2)
+        return self._stream.read(PCM_FRAME_BYTES)
+
+    def cleanup(self) -> None:
+        """
+        Close the file
+        """
+        if self._wav:
+            self._wav.close()
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up from short sleeps, and samples memory use
+    """
+
+    def __init__(self) -> None:
+        self.lags: List[float] = []
+        self.rss_peak = 0
+
+    async def run(self) -> None:
+        """
+        Sample until cancelled
+        """
+        samples = 0
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(time.perf_counter() - started - LAG_INTERVAL)
+
+            if samples % RSS_SAMPLE_EVERY == 0:
+                self.rss_peak = max(self.rss_peak, rss_bytes())
+            samples += 1
+
+
+@dataclass
+class ScenarioResult:
+    """
+    What one scenario measured. Times are in milliseconds and memory in MiB.
+    """
+
+    scenario: str
+    commands: int
+    errors: int
+    seconds: float
+    commands_per_second: float
+    p50: float
+    p95: float
+    p99: float
+    first_output_p50: float
+    audio_start_p50: float
+    loop_lag_p99: float
+    loop_lag_max: float
+    rss_start: float
+    rss_peak: float
+    python_peak: Optional[float]
+    queue_wait_avg: float
+    api_avg: float
+    retries: int
+    openai_failures: int
+
+
+@dataclass
+class PlaybackResult:
+    """
+    What encoding the playback clips with one engine cost
+    """
+
+    engine: str
+    clips: int = 0
+    packets: int = 0
+    seconds: float = 0.0
+    cpu_per_audio_minute: float = 0.0
+    realtime_factor: float = 0.0
+    note: str = ""
+
+
+@dataclass
+class SpeechResult:
+    """
+    How long generating speech took with or without splitting it into sentences, in milliseconds
+    """
+
+    mode: str
+    clips: int = 0
+    errors: int = 0
+    first_audio_p50: float = 0.0
+    first_audio_p95: float = 0.0
+    total_p50: float = 0.0
+    total_p95: float = 0.0
+
+
+@dataclass
+class ChatTableResult:
+    """
+    How long a chat turn's Chat table read and write took at one table size, in milliseconds
+    """
+
+    rows: int
+    turns: int
+    read_p50: float
+    read_p95: float
+    write_p50: float
+    write_p95: float
+    db_mib: float
+
+
+def speech_pcm(seconds: float) -> bytes:
+    """
+    A few harmonics of a wavering tone, as the Speech API's 24kHz, 16-bit mono PCM
+    """
+    samples = []
+    for n in range(int(seconds * 24000)):
+        t = n / 24000
+        pitch = 140 + 30 * math.sin(2 * math.pi * 3 * t)
+        samples.append(int(sum(3000 / k * math.sin(2 * math.pi * k * pitch * t) for k in (1, 2, 3))))
+    return b"".join(sample.to_bytes(2, "little", signed=True) for sample in samples)
+
+
+def cpu_seconds() -> float:
+    """
+    CPU time used by this process and its finished child processes
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def measure_playback(engine: str, clips: List[bytes]) -> PlaybackResult:
+    """
+    Play every clip through one engine's source as fast as it will go, and count the CPU time it took,
+    including FFmpeg's
+    """
+    import audio_helpers  # pylint: disable=C0415
+
+    result = PlaybackResult(engine=engine, clips=len(clips))
+    if engine == "ffmpeg" and not shutil.which("ffmpeg"):
+        result.note = "FFmpeg was not found"
+        return result
+    if engine != "ffmpeg" and not audio_helpers.opus_available():
+        result.note = "libopus could not be loaded"
+        return result
+
+    def stream(index: int, pcm: bytes) -> audio_helpers.SpeechStream:
+        speech = audio_helpers.SpeechStream()
+        speech.cache_key = f"benchmark-{index}" if engine == "opus_cached" else None
+        speech.feed(pcm)
+        speech.finish()
+        return speech
+
+    def play(source: Any) -> int:
+        packets = 0
+        while source.read():
+            packets += 1
+        source.cleanup()
+        return packets
+
+    if engine == "opus_cached":
+        for index, pcm in enumerate(clips):
+            play(audio_helpers.PCMOpusAudio(stream(index, pcm)))
+
+    cpu_started = cpu_seconds()
+    started = time.perf_counter()
+    for index, pcm in enumerate(clips):
+        speech = stream(index, pcm)
+        source = audio_helpers.ffmpeg_source(speech) if engine == "ffmpeg" else audio_helpers.PCMOpusAudio(speech)
+        result.packets += play(source)
+    elapsed = time.perf_counter() - started
+    result.seconds = round(elapsed, 3)
+
+    cpu = cpu_seconds() - cpu_started
+    audio_minutes = sum(len(pcm) for pcm in clips) / 2 / 24000 / 60
+    result.cpu_per_audio_minute = round(cpu / audio_minutes, 3)
+    result.realtime_factor = round(audio_minutes * 60 / elapsed, 1)
+    return result
+
+
+def run_playback(args: argparse.Namespace) -> List[PlaybackResult]:
+    """
+    Compare the playback engines on the same clips
+    """
+    pcm = speech_pcm(args.clip_seconds)
+    clips = [pcm] * max(1, round(args.playback_seconds / args.clip_seconds))
+    return [measure_playback(engine, clips) for engine in ("ffmpeg", "opus", "opus_cached")]
+
+
+def print_playback_results(results: List[PlaybackResult]) -> None:
+    """
+    Print the playback comparison as a table
+    """
+    print(f"{'engine':>12}  {'clips':>5}  {'packets':>7}  {'cpu s/audio min':>15}  {'x realtime':>10}  note")
+    for result in results:
+        print(
+            f"{result.engine:>12}  {result.clips:>5}  {result.packets:>7}  {result.cpu_per_audio_minute:>15}"
+            f"  {result.realtime_factor:>10}  {result.note}"
+        )
+
+
+def print_speech_results(results: List[SpeechResult]) -> None:
+    """
+    Print the speech chunking comparison as a table
+    """
+    print(f"{'mode':>8}  {'clips':>5}  {'errs':>4}  {'1st p50':>8}  {'1st p95':>8}  {'total p50':>9}  {'total p95':>9}")
+    for result in results:
+        print(
+            f"{result.mode:>8}  {result.clips:>5}  {result.errors:>4}  {result.first_audio_p50:>8}"
+            f"  {result.first_audio_p95:>8}  {result.total_p50:>9}  {result.total_p95:>9}"
+        )
+
+
+def print_chat_table_results(results: List[ChatTableResult]) -> None:
+    """
+    Print the Chat table growth measurements as a table
+    """
+    print(f"{'rows':>9}  {'turns':>5}  {'read p50':>8}  {'read p95':>8}  {'write p50':>9}  {'write p95':>9}  db MiB")
+    for result in results:
+        print(
+            f"{result.rows:>9}  {result.turns:>5}  {result.read_p50:>8}  {result.read_p95:>8}"
+            f"  {result.write_p50:>9}  {result.write_p95:>9}  {result.db_mib:>6}"
+        )
+
+
+def _grow_chat_table(start: int, stop: int) -> None:
+    # rows spread over many guilds, keyed by user id like /chat's own conversations
+    from sqlalchemy import insert  # pylint: disable=C0415
+
+    from db_utils import Chat, get_session  # pylint: disable=C0415
+
+    now = datetime.now()
+    with get_session() as session:
+        for batch in range(start, stop, CHAT_TABLE_BATCH):
+            rows = [
+                {
+                    "guild_id": CHAT_TABLE_GUILDS + n % CHAT_TABLE_GUILDS,
+                    "topic": str(n),
+                    "response_id": f"resp_{n:024x}",
+                    "updated": now,
+                    "context_tokens": n % 8000,
+                    "turns": 1 + n % 20,
+                }
+                for n in range(batch, min(batch + CHAT_TABLE_BATCH, stop))
+            ]
+            session.execute(insert(Chat), rows)
+            session.commit()
+
+
+def chat_table_steps(rows: int) -> List[int]:
+    """
+    The table sizes to measure at: powers of ten up to rows, then rows itself
+    """
+    steps = []
+    step = 1000
+    while step < rows:
+        steps.append(step)
+        step *= 10
+    return steps + [rows]
+
+
+def db_bytes(file_name: str) -> int:
+    """
+    The size of the SQLite database, including the pages still in its write-ahead log
+    """
+    return sum(os.path.getsize(path) for path in (file_name, f"{file_name}-wal") if os.path.exists(path))
+
+
+def rss_bytes() -> int:
+    """
+    The process's resident memory, or its peak where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm", encoding="UTF-8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    The nearest-rank percentile of values, or 0 if there are none
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def create_baseline_db(file_name: str) -> None:
+    """
+    Write a database with the bot's original schema and a conversation that was continued once
+    """
+    with sqlite3.connect(file_name) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+    connection.close()
+
+
+def check_migrations() -> None:
+    """
+    Make sure init_db() carried the baseline database's conversation over to the current Chat table
+    """
+    from db_utils import Chat, get_session  # pylint: disable=C0415
+
+    with get_session() as session:
+        chat = session.get(Chat, (1, "baseline"))
+    if not chat or chat.response_id != "resp_new" or chat.turns != 0 or chat.context_tokens != 0:
+        raise RuntimeError(f"init_db() didn't migrate the baseline Chat table correctly: {chat}")
+
+
+def free_port() -> int:
+    """
+    Ask the OS for an unused local port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    """
+    Block until something is listening on the port
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class Benchmark:
+    """
+    Runs scenarios against the imported bot module and collects their results
+    """
+
+    def __init__(self, app: ModuleType, args: argparse.Namespace) -> None:
+        self.app = app
+        self.args = args
+        self.audio_starts: List[float] = []
+        self.guilds = [
+            FakeGuild(guild_id=guild_id, realtime=args.realtime_voice, audio_starts=self.audio_starts)
+            for guild_id in range(1, args.guilds + 1)
+        ]
+
+        # the handlers find voice clients through the bot, and the talk scheduler finds guilds through it
+        for guild in self.guilds if args.voice else []:
+            app.bot._connection._add_voice_client(guild.id, guild.voice_client)  # pylint: disable=W0212
+        app.talk_scheduler.bot = FakeBot(self.guilds)
+
+    async def run(self, name: str) -> ScenarioResult:
+        """
+        Run one scenario with the loop monitor going
+        """
+        # imported here so they come from the same module instances as the bot's
+        from fair_queue import openai_queue_stats  # pylint: disable=C0415
+        from openai_requests import openai_request_stats  # pylint: disable=C0415
+
+        monitor = LoopMonitor()
+        monitor_task = asyncio.create_task(monitor.run())
+        requests_before = dict(openai_request_stats)
+        queue_before = dict(openai_queue_stats)
+        self.audio_starts.clear()
+        rss_start = rss_bytes()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        started = time.perf_counter()
+        if name == "talk":
+            timings, latencies, errors = await self._talk()
+        else:
+            timings, errors = await self._commands(name)
+            latencies = [(timing.finished - timing.started) * 1000 for timing in timings]
+        seconds = time.perf_counter() - started
+
+        await self._drain_voice()
+        monitor_task.cancel()
+
+        granted = openai_queue_stats["granted"] - queue_before["granted"]
+        return ScenarioResult(
+            scenario=name,
+            commands=len(latencies),
+            errors=errors,
+            seconds=round(seconds, 2),
+            commands_per_second=round(len(latencies) / seconds, 2),
+            p50=round(percentile(latencies, 50), 1),
+            p95=round(percentile(latencies, 95), 1),
+            p99=round(percentile(latencies, 99), 1),
+            first_output_p50=round(
+                percentile([(t.first_output - t.started) * 1000 for t in timings if t.first_output], 50), 1
+            ),
+            audio_start_p50=round(percentile([start * 1000 for start in self.audio_starts], 50), 1),
+            loop_lag_p99=round(percentile(monitor.lags, 99) * 1000, 2),
+            loop_lag_max=round(max(monitor.lags, default=0.0) * 1000, 2),
+            rss_start=round(rss_start / 2**20, 1),
+            rss_peak=round(max(monitor.rss_peak, rss_bytes()) / 2**20, 1),
+            python_peak=round(tracemalloc.get_traced_memory()[1] / 2**20, 1) if tracemalloc.is_tracing() else None,
+            queue_wait_avg=round(
+                (openai_queue_stats["wait_seconds_total"] - queue_before["wait_seconds_total"]) * 1000 / granted, 1
+            )
+            if granted
+            else 0.0,
+            api_avg=round(
+                (openai_queue_stats["api_seconds_total"] - queue_before["api_seconds_total"]) * 1000 / granted, 1
+            )
+            if granted
+            else 0.0,
+            retries=openai_request_stats["retries"] - requests_before["retries"],
+            openai_failures=openai_request_stats["failures"] - requests_before["failures"],
+        )
+
+    async def _commands(self, name: str) -> Tuple[List[CommandTiming], int]:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        timings: List[CommandTiming] = []
+        errors = 0
+
+        async def invoke(index: int) -> None:
+            nonlocal errors
+            scenario = SCENARIOS[random.choice(MIXED) if name == "mixed" else name]
+            guild = self.guilds[index % len(self.guilds)]
+            user_id = guild.id * 1000 + index % self.args.users
+
+            async with semaphore:
+                timing = CommandTiming()
+                interaction = FakeInteraction(scenario.command, guild=guild, user_id=user_id, timing=timing)
+                try:
+                    await getattr(self.app, scenario.command).callback(interaction, **scenario.make_kwargs(index))
+                except Exception:  # pylint: disable=W0718
+                    errors += 1
+                    if errors <= 3:
+                        logger.exception("/%s failed", scenario.command)
+                finally:
+                    timing.finished = time.perf_counter()
+                    timings.append(timing)
+
+        await asyncio.gather(*(invoke(index) for index in range(self.args.commands)))
+        return timings, errors
+
+    async def _talk(self) -> Tuple[List[CommandTiming], List[float], int]:
+        """
+        Start a talk loop in every guild and measure how far apart its messages land compared to the interval
+        """
+        interval = self.args.talk_interval
+        timings = []
+
+        for guild in self.guilds:
+            guild.text_channel.sent.clear()
+            timing = CommandTiming()
+            interaction = FakeInteraction("talk", guild=guild, user_id=guild.id * 1000, timing=timing)
+            await self.app.talk.callback(interaction, topic="nonsense", wait_minutes=interval / 60)
+            timing.finished = time.perf_counter()
+            timings.append(timing)
+
+        await asyncio.sleep(self.args.talk_seconds)
+
+        for guild in self.guilds:
+            await self.app.talk_scheduler.stop(guild.id)
+
+        lateness = [
+            abs(later - earlier - interval) * 1000
+            for guild in self.guilds
+            for earlier, later in zip(guild.text_channel.sent, guild.text_channel.sent[1:])
+        ]
+        return timings, lateness, 0
+
+    async def _drain_voice(self) -> None:
+        """
+        Wait for queued clips to finish so one scenario's playback doesn't bleed into the next
+        """
+        from voice_queue import voice_queue_stats  # pylint: disable=C0415
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            finished = voice_queue_stats["played"] + voice_queue_stats["skipped"] + voice_queue_stats["rejected"]
+            if finished >= voice_queue_stats["enqueued"] + voice_queue_stats["rejected"]:
+                return
+            await asyncio.sleep(0.05)
+
+    async def speech(self) -> List[SpeechResult]:
+        """
+        Generate the same kind of long text as sentence chunks and as single requests, timing the first
+        audio fed to the player and the finished file
+        """
+        import ai_helpers  # pylint: disable=C0415
+
+        split_sentences = ai_helpers.split_sentences
+        results = [await self._speech("chunked")]
+
+        ai_helpers.split_sentences = lambda text: [text.strip()]
+        try:
+            results.append(await self._speech("single"))
+        finally:
+            ai_helpers.split_sentences = split_sentences
+
+        return results
+
+    async def _speech(self, mode: str) -> SpeechResult:
+        import ai_helpers  # pylint: disable=C0415
+        from audio_helpers import SpeechStream  # pylint: disable=C0415
+        from db_utils import CommandContext  # pylint: disable=C0415
+
+        class TimedSpeechStream(SpeechStream):
+            """
+            A speech stream that notes when its first audio arrived
+            """
+
+            def __init__(self) -> None:
+                super().__init__()
+                self.first_audio: Optional[float] = None
+
+            def feed(self, data: bytes) -> None:
+                if data and self.first_audio is None:
+                    self.first_audio = time.perf_counter()
+                super().feed(data)
+
+        result = SpeechResult(mode=mode)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        first_audio: List[float] = []
+        totals: List[float] = []
+
+        async def generate(index: int) -> None:
+            guild = self.guilds[index % len(self.guilds)]
+            context = CommandContext(guild_id=guild.id, user_id=guild.id * 1000, user="benchmark", command_name="say")
+            stream = TimedSpeechStream()
+
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    # unique text, so neither mode is served from the speech cache
+                    await ai_helpers.generate_speech(
+                        context=context,
+                        file_name=f"{mode}_{index}.wav",
+                        tts=f"{LONG_TEXT} {LONG_TEXT} This was {mode} number {index}.",
+                        stream=stream,
+                    )
+                except Exception:  # pylint: disable=W0718
+                    result.errors += 1
+                    if result.errors <= 3:
+                        logger.exception("%s speech failed", mode)
+                    return
+                totals.append((time.perf_counter() - started) * 1000)
+                if stream.first_audio:
+                    first_audio.append((stream.first_audio - started) * 1000)
+
+        await asyncio.gather(*(generate(index) for index in range(self.args.commands)))
+
+        result.clips = len(totals)
+        result.first_audio_p50 = round(percentile(first_audio, 50), 1)
+        result.first_audio_p95 = round(percentile(first_audio, 95), 1)
+        result.total_p50 = round(percentile(totals, 50), 1)
+        result.total_p95 = round(percentile(totals, 95), 1)
+        logger.info("tts %s: %s clips", mode, result.clips)
+        return result
+
+    async def chat_table(self) -> List[ChatTableResult]:
+        """
+        Grow the Chat table in steps and time a chat turn's read and write of random conversations at each size
+        """
+        from db_utils import SQLITE_FILE_NAME, CommandContext, get_chat, run_in_db, update_chat  # pylint: disable=C0415
+
+        results = []
+        rows = 0
+        for step in chat_table_steps(self.args.chat_rows):
+            started = time.perf_counter()
+            await run_in_db(_grow_chat_table, rows, step)
+            logger.info("Grew the Chat table to %s rows in %.1fs", step, time.perf_counter() - started)
+            rows = step
+
+            reads: List[float] = []
+            writes: List[float] = []
+            for _ in range(self.args.commands):
+                n = random.randrange(rows)
+                context = CommandContext(
+                    guild_id=CHAT_TABLE_GUILDS + n % CHAT_TABLE_GUILDS,
+                    user_id=n,
+                    user="benchmark",
+                    command_name="chat",
+                    params={"topic": str(n), "keep_chatting": True},
+                )
+
+                started = time.perf_counter()
+                chat = await get_chat(context=context)
+                reads.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                await update_chat(response_id="resp_benchmark", context=context, turns=chat.turns + 1 if chat else 1)
+                writes.append((time.perf_counter() - started) * 1000)
+
+            results.append(
+                ChatTableResult(
+                    rows=rows,
+                    turns=len(reads),
+                    read_p50=round(percentile(reads, 50), 2),
+                    read_p95=round(percentile(reads, 95), 2),
+                    write_p50=round(percentile(writes, 50), 2),
+                    write_p95=round(percentile(writes, 95), 2),
+                    db_mib=round(db_bytes(SQLITE_FILE_NAME) / 2**20, 1),
+                )
+            )
+
+        return results
+
+
+def print_results(results: List[ScenarioResult]) -> None:
+    """
+    Print the results as a table
+    """
+    columns = [
+        ("scenario", "scenario", 13),
+        ("commands", "cmds", 5),
+        ("errors", "errs", 4),
+        ("commands_per_second", "cmd/s", 7),
+        ("p50", "p50 ms", 8),
+        ("p95", "p95 ms", 8),
+        ("p99", "p99 ms", 8),
+        ("first_output_p50", "1st ms", 8),
+        ("audio_start_p50", "audio ms", 8),
+        ("loop_lag_p99", "lag p99", 7),
+        ("loop_lag_max", "lag max", 7),
+        ("rss_peak", "rss MiB", 7),
+        ("queue_wait_avg", "queue ms", 8),
+        ("api_avg", "api ms", 8),
+        ("retries", "retry", 5),
+    ]
+    print("  ".join(title.rjust(width) for _, title, width in columns))
+    for result in results:
+        row = asdict(result)
+        print("  ".join(str(row[key]).rjust(width) for key, _, width in columns))
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Read the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the bot's commands offline.")
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=[*SCENARIOS, *EXTRA_SCENARIOS],
+        help="Scenarios to run (default: all).",
+    )
+    parser.add_argument("--commands", type=int, default=50, help="Commands per scenario.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Commands in flight at once.")
+    parser.add_argument("--guilds", type=int, default=4, help="Guilds to spread the commands over.")
+    parser.add_argument("--users", type=int, default=5, help="Users per guild.")
+    parser.add_argument("--no-voice", dest="voice", action="store_false", help="Run without voice clients.")
+    parser.add_argument("--realtime-voice", action="store_true", help="Play audio at real-time speed.")
+    parser.add_argument("--talk-interval", type=float, default=2.0, help="Seconds between talk messages.")
+    parser.add_argument("--talk-seconds", type=float, default=15.0, help="How long the talk scenario runs.")
+    parser.add_argument("--playback-seconds", type=float, default=60.0, help="Audio per playback engine.")
+    parser.add_argument("--clip-seconds", type=float, default=5.0, help="Length of each playback clip.")
+    parser.add_argument("--chat-rows", type=int, default=100000, help="Rows to grow the Chat table to.")
+    parser.add_argument("--config", type=Path, default=REPO_DIR / "config.ini", help="The config ini to use.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the Python heap's peak.")
+    parser.add_argument("--json", type=Path, help="Write the results to this file as JSON.")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory afterwards.")
+    mock_openai.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.json:
+        args.json = args.json.resolve()
+    unknown = set(args.scenarios) - {*SCENARIOS, *EXTRA_SCENARIOS}
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+async def run_all(app: ModuleType, args: argparse.Namespace) -> List[Any]:
+    """
+    Run every requested scenario in order
+    """
+    from db_utils import audit_sink  # pylint: disable=C0415
+
+    benchmark = Benchmark(app=app, args=args)
+    results: List[Any] = []
+
+    for name in args.scenarios:
+        if name == "tts":
+            results.extend(await benchmark.speech())
+        elif name == "chat_table":
+            results.extend(await benchmark.chat_table())
+        else:
+            result = await benchmark.run(name)
+            results.append(result)
+            logger.info("%s: %s commands in %ss", name, result.commands, result.seconds)
+
+    await audit_sink.close()
+    return results
+
+
+def run_commands(args: argparse.Namespace) -> List[Any]:
+    """
+    Start the mock API, set up a scratch bot environment, and run the command scenarios
+    """
+    port = free_port()
+    mock = multiprocessing.get_context("spawn").Process(
+        target=mock_openai.run, args=(port, mock_openai.options_from(args)), daemon=True
+    )
+    mock.start()
+    wait_for_port(port)
+
+    # the bot keeps its database, config and generated content in the working directory
+    workdir = Path(tempfile.mkdtemp(prefix="bot-benchmark-"))
+    shutil.copyfile(args.config, workdir / "config.ini")
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_DIR))
+    create_baseline_db("database.db")
+
+    fernet_key = Fernet.generate_key()
+    os.environ["FERNET_KEY"] = fernet_key.decode()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    try:
+        import app  # pylint: disable=C0415
+        import voice_queue  # pylint: disable=C0415
+        from audio_helpers import opus_available  # pylint: disable=C0415
+        from db_utils import Key, get_session, init_db  # pylint: disable=C0415
+
+        init_db()
+        check_migrations()
+        with get_session() as session:
+            for guild_id in range(1, args.guilds + 1):
+                api_key = Fernet(fernet_key).encrypt(b"sk-benchmark").decode()
+                session.add(Key(guild_id=guild_id, guild_name=f"Benchmark {guild_id}", api_key=api_key))
+            session.commit()
+
+        if not opus_available() and not shutil.which("ffmpeg"):
+            logger.warning("Neither libopus nor FFmpeg was found; voice clips are drained as raw PCM instead.")
+            voice_queue.speech_source = RawPCMSource
+
+        return asyncio.run(run_all(app=app, args=args))
+    finally:
+        # the mock is disposable, and a graceful shutdown only trips over requests still in flight
+        mock.kill()
+        os.chdir(REPO_DIR)
+        if args.keep:
+            print(f"Kept the working directory {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    """
+    Run the requested scenarios and report on them
+    """
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("metrics").setLevel(logging.WARNING)
+
+    playback = "playback" in args.scenarios
+    args.scenarios = [name for name in args.scenarios if name != "playback"]
+
+    results = run_commands(args) if args.scenarios else []
+    playback_results = run_playback(args) if playback else []
+
+    for kind, print_table in (
+        (ScenarioResult, print_results),
+        (SpeechResult, print_speech_results),
+        (ChatTableResult, print_chat_table_results),
+    ):
+        if rows := [result for result in results if isinstance(result, kind)]:
+            print_table(rows)
+    if playback_results:
+        print_playback_results(playback_results)
+    if args.json:
+        rows = [asdict(result) for result in results] + [asdict(result) for result in playback_results]
+        args.json.write_text(json.dumps(rows, indent=2), encoding="UTF-8")
+
+
+if __name__ == "__main__":
+    main()
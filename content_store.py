@@ -0,0 +1,210 @@
+"""
+Keeps generated_content bounded: an index of the stored files, Opus transcoding of old WAVs, and age and per-guild
+size limits
+"""
+
+import asyncio
+import logging
+import shutil
+from asyncio.subprocess import DEVNULL, PIPE
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from db_utils import (
+    Artifact,
+    delete_artifacts,
+    get_artifact_usage,
+    get_artifacts,
+    get_content_scan,
+    save_artifacts,
+    save_content_scan,
+)
+
+CONTENT_ROOT = Path("generated_content")
+OPUS_BITRATE = "32k"
+
+logger = logging.getLogger(__name__)
+content_store_stats: Dict[str, int] = {
+    "files": 0,
+    "bytes": 0,
+    "transcoded": 0,
+    "transcode_bytes_saved": 0,
+    "expired": 0,
+    "over_quota": 0,
+}
+
+
+async def index_artifact(guild_id: int, command_name: str, path: Path) -> None:
+    """
+    Record a newly written file in the content index
+    """
+    size = (await asyncio.to_thread(path.stat)).st_size
+    await save_artifacts([Artifact(path=str(path), guild_id=guild_id, command_name=command_name, size=size)])
+
+
+def _scan(root: Path) -> List[Artifact]:
+    # guild_<id>/<day>/<command>/<file>; the speech cache manages its own directory
+    artifacts = []
+    for guild_dir in root.glob("guild_*"):
+        try:
+            guild_id = int(guild_dir.name.removeprefix("guild_"))
+        except ValueError:
+            continue
+
+        for path in guild_dir.glob("*/*/*"):
+            if path.is_file():
+                stat = path.stat()
+                artifacts.append(
+                    Artifact(
+                        path=str(path),
+                        guild_id=guild_id,
+                        command_name=path.parent.name,
+                        size=stat.st_size,
+                        created=datetime.fromtimestamp(stat.st_mtime),
+                    )
+                )
+    return artifacts
+
+
+async def build_index(root: Path = CONTENT_ROOT) -> int:
+    """
+    Index the files written before the index existed. The tree is only walked until a scan of it has finished,
+    since other processes may already be indexing the files they write.
+    """
+    if await get_content_scan(str(root)):
+        return 0
+
+    artifacts = await asyncio.to_thread(_scan, root)
+    await save_artifacts(artifacts)
+    await save_content_scan(str(root))
+    if artifacts:
+        logger.info("Indexed %s existing files in %s", len(artifacts), root)
+    return len(artifacts)
+
+
+async def transcode_to_opus(path: Path) -> Optional[Path]:
+    """
+    Re-encode a WAV file as Ogg Opus next to it and delete the WAV. Returns the new path, or None on failure.
+    """
+    opus_path = path.with_suffix(".ogg")
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        str(path),
+        "-c:a",
+        "libopus",
+        "-b:a",
+        OPUS_BITRATE,
+        str(opus_path),
+        stdout=DEVNULL,
+        stderr=PIPE,
+    )
+    _, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        logger.warning("Could not transcode %s: %s", path, stderr.decode(errors="replace").strip())
+        await asyncio.to_thread(opus_path.unlink, missing_ok=True)
+        return None
+
+    await asyncio.to_thread(path.unlink, missing_ok=True)
+    return opus_path
+
+
+async def _transcode(artifacts: List[Artifact]) -> None:
+    # one file at a time, so a backlog of old WAVs doesn't take every core away from the bot
+    for artifact in artifacts:
+        if not (opus_path := await transcode_to_opus(Path(artifact.path))):
+            continue
+
+        size = (await asyncio.to_thread(opus_path.stat)).st_size
+        await delete_artifacts([artifact.path])
+        await save_artifacts(
+            [
+                Artifact(
+                    path=str(opus_path),
+                    guild_id=artifact.guild_id,
+                    command_name=artifact.command_name,
+                    size=size,
+                    created=artifact.created,
+                )
+            ]
+        )
+        content_store_stats["transcoded"] += 1
+        content_store_stats["transcode_bytes_saved"] += artifact.size - size
+
+
+def _delete_files(paths: List[Path]) -> int:
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+    # drop the command and day directories that are now empty, but leave today's alone since they're still written to
+    today = date.today().isoformat()
+    directories: Set[Path] = {path.parent for path in paths} | {path.parent.parent for path in paths}
+    removed = 0
+    for directory in sorted(directories, key=lambda directory: len(directory.parts), reverse=True):
+        day_dir = directory if directory.parent.name.startswith("guild_") else directory.parent
+        if day_dir.name.startswith(today):
+            continue
+        try:
+            directory.rmdir()
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+async def _remove(artifacts: List[Artifact]) -> int:
+    if not artifacts:
+        return 0
+
+    removed = await asyncio.to_thread(_delete_files, [Path(artifact.path) for artifact in artifacts])
+    await delete_artifacts([artifact.path for artifact in artifacts])
+    return removed
+
+
+async def sweep(
+    guild_quota_bytes: int = 0, max_age: Optional[timedelta] = None, transcode_after: Optional[timedelta] = None
+) -> int:
+    """
+    Transcode WAVs older than transcode_after to Opus, delete files older than max_age, then delete each guild's
+    oldest files until it's within guild_quota_bytes. Returns the number of directories removed along the way.
+    """
+    now = datetime.now()
+    removed = 0
+
+    if transcode_after is not None:
+        if shutil.which("ffmpeg"):
+            await _transcode(await get_artifacts(created_before=now - transcode_after, suffix=".wav"))
+        else:
+            logger.warning("ffmpeg isn't installed, so old WAV files can't be transcoded")
+
+    if max_age is not None:
+        expired = await get_artifacts(created_before=now - max_age)
+        content_store_stats["expired"] += len(expired)
+        removed += await _remove(expired)
+
+    if guild_quota_bytes > 0:
+        for guild_id, (_, size) in (await get_artifact_usage()).items():
+            if size <= guild_quota_bytes:
+                continue
+
+            evicted = []
+            for artifact in await get_artifacts(guild_id=guild_id):
+                if size <= guild_quota_bytes:
+                    break
+                evicted.append(artifact)
+                size -= artifact.size
+
+            logger.info("Guild %s is over its storage quota; deleting its %s oldest files", guild_id, len(evicted))
+            content_store_stats["over_quota"] += len(evicted)
+            removed += await _remove(evicted)
+
+    usage = await get_artifact_usage()
+    content_store_stats["files"] = sum(count for count, _ in usage.values())
+    content_store_stats["bytes"] = sum(size for _, size in usage.values())
+
+    return removed
@@ -2,17 +2,61 @@
 Functions to work with the database
 """
 
+import asyncio
+import contextvars
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, Optional, Union
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 from cryptography.fernet import Fernet
 from discord import Interaction
+from sqlalchemy import delete, event, inspect, text
+from sqlalchemy import func as sql_func
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import JSON, Column, Field, Session, SQLModel, create_engine, select
 
+from metrics import traced
+
+logger = logging.getLogger(__name__)
+
 SQLITE_FILE_NAME = "database.db"
 SQLITE_URL = f"sqlite:///{SQLITE_FILE_NAME}"
-engine = create_engine(SQLITE_URL)
+DB_POOL_SIZE = 4
+ARTIFACT_BATCH_SIZE = 500
+
+# one pooled connection per database worker thread; SQLite handles the locking between them
+engine = create_engine(
+    SQLITE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=0,
+    connect_args={"check_same_thread": False, "timeout": 30},
+)
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+T = TypeVar("T")
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+    """
+    WAL lets readers run alongside a writer, and NORMAL sync skips the fsync on every commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+@traced("db")
+async def run_in_db(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking database function on the database thread pool so the event loop stays free.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
 
 
 class CommandContext(SQLModel, table=True):
@@ -30,15 +74,81 @@ class CommandContext(SQLModel, table=True):
 
     async def save(self) -> bool:
         """
-        Writes a CommandContext to the db
+        Queues a CommandContext to be written to the db with the next audit batch
         """
 
-        with get_session() as session:
-            session.add(self)
-            session.commit()
+        audit_sink.add(self)
         return True
 
 
+class AuditSink:
+    """
+    Buffers CommandContext rows in memory and writes them in batched transactions,
+    whenever the buffer fills up or the flush interval passes
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 5.0) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[CommandContext] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, context: CommandContext) -> None:
+        """
+        Queue a record without waiting on the database
+        """
+        self._buffer.append(context)
+
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+        if not self._task or self._task.done():
+            # outlives the command that queued the first row, so it mustn't inherit that command's trace
+            self._task = asyncio.create_task(self._flush_forever(), name="audit-sink", context=contextvars.Context())
+
+    async def flush(self) -> None:
+        """
+        Write everything buffered so far in one transaction
+        """
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+
+        try:
+            await run_in_db(_save_all, batch)
+        except Exception:  # pylint: disable=W0718
+            logger.exception("Could not write %s command records; keeping them for the next flush", len(batch))
+            self._buffer[:0] = batch
+
+    async def close(self) -> None:
+        """
+        Stop the background flusher and write whatever is left
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_forever(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+
+def _save_all(records: List[SQLModel]) -> None:
+    # the records are still in use by whoever queued them, so don't expire them on commit
+    with Session(engine, expire_on_commit=False) as session:
+        session.add_all(records)
+        session.commit()
+
+
+audit_sink = AuditSink()
+
+
 class Key(SQLModel, table=True):
     """
     Table for storing OpenAI API keys.
@@ -51,13 +161,95 @@ class Key(SQLModel, table=True):
 
 class Chat(SQLModel, table=True):
     """
-    Table for storing OpenAI Response IDs
+    Table for storing the latest OpenAI Response ID per guild and topic
     """
 
-    response_id: str = Field(default=None, primary_key=True)
-    topic: str
-    guild_id: int
+    guild_id: int = Field(primary_key=True)
+    topic: str = Field(primary_key=True)
+    response_id: str
     updated: datetime
+    # the size of the conversation so far, as of the latest response's usage
+    context_tokens: int = 0
+    turns: int = 0
+
+
+class TalkJob(SQLModel, table=True):
+    """
+    Table for storing the active /talk loops so they survive restarts
+    """
+
+    guild_id: int = Field(primary_key=True)
+    text_channel_id: int
+    voice_channel_id: int
+    topic: str
+    interval: float
+    next_run: datetime
+    user_id: int
+    user: str
+
+
+class SpeechClip(SQLModel, table=True):
+    """
+    Table indexing the cached text-to-speech audio files
+    """
+
+    key: str = Field(primary_key=True)
+    path: str
+    size: int
+    last_used: datetime = Field(default_factory=datetime.now, index=True)
+    hits: int = 0
+
+
+class Artifact(SQLModel, table=True):
+    """
+    Table indexing the files in generated_content, so storage can be managed without walking the tree
+    """
+
+    path: str = Field(primary_key=True)
+    guild_id: int = Field(index=True)
+    command_name: str
+    size: int
+    created: datetime = Field(default_factory=datetime.now, index=True)
+
+
+class ContentScan(SQLModel, table=True):
+    """
+    Table remembering the content directories whose existing files have been added to the Artifact index
+    """
+
+    root: str = Field(primary_key=True)
+    finished: datetime = Field(default_factory=datetime.now)
+
+
+class CommandSync(SQLModel, table=True):
+    """
+    Table remembering the slash command definitions last synced to each scope (global or a guild)
+    """
+
+    scope: str = Field(primary_key=True)
+    fingerprint: str
+    synced: datetime = Field(default_factory=datetime.now)
+
+
+class ModelUsage(SQLModel, table=True):
+    """
+    Table counting uses of limited models per scope (a guild or a user) and day
+    """
+
+    scope: str = Field(primary_key=True)
+    model: str = Field(primary_key=True)
+    period: str = Field(primary_key=True)
+    count: int = 0
+
+
+# one statement per scope: insert the first use or bump the count, but only while it's under the limit
+INCREMENT_USAGE = text(
+    f"""
+    INSERT INTO {ModelUsage.__tablename__} (scope, model, period, count) VALUES (:scope, :model, :period, 1)
+    ON CONFLICT (scope, model, period) DO UPDATE SET count = count + 1 WHERE count < :limit
+    RETURNING count
+    """
+)
 
 
 async def create_command_context(interaction: Interaction, params: Optional[Dict[str, Any]] = None) -> CommandContext:
@@ -79,6 +271,83 @@ async def create_command_context(interaction: Interaction, params: Optional[Dict
     return context
 
 
+def init_db() -> None:
+    """
+    Create any tables that don't exist yet and migrate old ones.
+    """
+
+    migrate_chat_table()
+    migrate_chat_usage()
+    SQLModel.metadata.create_all(engine)
+
+
+def migrate_chat_table() -> None:
+    """
+    Older databases keyed the Chat table on response_id. Rebuild it keyed on (guild_id, topic),
+    keeping the most recent response for each pair.
+    """
+
+    inspector = inspect(engine)
+    if not inspector.has_table(Chat.__tablename__):
+        return
+    if inspector.get_pk_constraint(Chat.__tablename__)["constrained_columns"] != ["response_id"]:
+        return
+
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {Chat.__tablename__} RENAME TO chat_old"))
+        Chat.__table__.create(connection)
+        # SQLite takes the bare columns from the row that holds MAX(updated)
+        connection.execute(
+            text(
+                f"""
+                INSERT INTO {Chat.__tablename__} (guild_id, topic, response_id, updated, context_tokens, turns)
+                SELECT guild_id, topic, response_id, MAX(updated), 0, 0 FROM chat_old GROUP BY guild_id, topic
+                """
+            )
+        )
+        connection.execute(text("DROP TABLE chat_old"))
+
+
+def migrate_chat_usage() -> None:
+    """
+    Add the token accounting columns to Chat tables created before they existed
+    """
+
+    inspector = inspect(engine)
+    if not inspector.has_table(Chat.__tablename__):
+        return
+
+    columns = {column["name"] for column in inspector.get_columns(Chat.__tablename__)}
+    with engine.begin() as connection:
+        for column in ("context_tokens", "turns"):
+            if column not in columns:
+                connection.execute(
+                    text(f"ALTER TABLE {Chat.__tablename__} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+                )
+
+
+def _upsert(record: SQLModel) -> None:
+    """
+    Insert a row or overwrite the existing one with the same primary key, in one statement
+    so concurrent writers can't both try to insert it.
+    """
+
+    table = type(record).__table__
+    values = record.model_dump()
+    primary_key = [column.name for column in table.primary_key]
+    statement = (
+        insert(table)
+        .values(**values)
+        .on_conflict_do_update(
+            index_elements=primary_key, set_={key: value for key, value in values.items() if key not in primary_key}
+        )
+    )
+
+    with get_session() as session:
+        session.execute(statement)
+        session.commit()
+
+
 def get_session() -> Session:
     """
     Returns a database session for queries 'n' things.
@@ -87,53 +356,55 @@ def get_session() -> Session:
     return Session(engine)
 
 
-async def get_response_id(context: CommandContext) -> Union[str, None]:
+async def get_chat(context: CommandContext) -> Optional[Chat]:
     """
-    Looks for a previous reponse id if one exists for a given "command" in the Chat table
+    Looks for the conversation a given "command" is continuing in the Chat table
     """
 
-    with get_session() as session:
-        statement = (
-            select(Chat).where(Chat.guild_id == context.guild_id).where(Chat.topic == context.params.get("topic"))
-        )
-        results = session.exec(statement=statement)
-        response_record = results.one_or_none()
+    return await run_in_db(
+        _get_chat,
+        guild_id=context.guild_id,
+        topic=context.params.get("topic"),
+        keep_chatting=context.params.get("keep_chatting"),
+    )
 
-        # special case for user chat completions
-        if not context.params.get("keep_chatting"):
-            return None
 
-        return response_record.response_id if response_record else None
+def _get_chat(guild_id: int, topic: str, keep_chatting: Optional[bool]) -> Optional[Chat]:
+    # special case for user chat completions
+    if not keep_chatting:
+        return None
 
+    with get_session() as session:
+        return session.get(Chat, (guild_id, topic))
 
-async def update_chat(response_id: str, context: CommandContext) -> None:
+
+async def update_chat(response_id: str, context: CommandContext, context_tokens: int = 0, turns: int = 1) -> None:
     """
     Update the command's record in the Chat table.
     """
 
-    with get_session() as session:
-        statement = (
-            select(Chat).where(Chat.guild_id == context.guild_id).where(Chat.topic == context.params.get("topic"))
-        )
-        results = session.exec(statement=statement)
-        response = results.one_or_none()
+    return await run_in_db(
+        _update_chat,
+        response_id=response_id,
+        guild_id=context.guild_id,
+        topic=context.params.get("topic"),
+        context_tokens=context_tokens,
+        turns=turns,
+    )
 
-        if response:
-            response.response_id = response_id
-            response.updated = datetime.now()
-            session.add(response)
-            session.commit()
-        else:
-            entry = Chat(
-                response_id=response_id,
-                topic=context.params.get("topic"),
-                guild_id=context.guild_id,
-                updated=datetime.now(),
-            )
-            session.add(entry)
-            session.commit()
 
-    return
+def _update_chat(response_id: str, guild_id: int, topic: str, context_tokens: int, turns: int) -> None:
+    now = datetime.now()
+    values = {"response_id": response_id, "updated": now, "context_tokens": context_tokens, "turns": turns}
+    statement = (
+        insert(Chat)
+        .values(guild_id=guild_id, topic=topic, **values)
+        .on_conflict_do_update(index_elements=["guild_id", "topic"], set_=values)
+    )
+
+    with get_session() as session:
+        session.execute(statement)
+        session.commit()
 
 
 async def get_api_key(guild_id: int) -> str:
@@ -146,7 +417,12 @@ async def get_api_key(guild_id: int) -> str:
         raise ValueError("FERNET_KEY environment variable not set!")
 
     cipher = Fernet(fernet_key.encode())
+    encrypted_key = await run_in_db(_get_encrypted_api_key, guild_id=guild_id)
 
+    return cipher.decrypt(encrypted_key.encode()).decode()
+
+
+def _get_encrypted_api_key(guild_id: int) -> str:
     with get_session() as session:
         statement = select(Key).where(Key.guild_id == guild_id)
         results = session.exec(statement=statement)
@@ -155,11 +431,240 @@ async def get_api_key(guild_id: int) -> str:
         if not key_record:
             raise ValueError(f"No API token found for guild_id: {guild_id}")
 
-        return cipher.decrypt(key_record.api_key.encode()).decode()
+        return key_record.api_key
+
+
+async def get_talk_jobs() -> List[TalkJob]:
+    """
+    Load every active /talk loop.
+    """
+
+    return await run_in_db(_get_talk_jobs)
+
+
+def _get_talk_jobs() -> List[TalkJob]:
+    with get_session() as session:
+        return list(session.exec(select(TalkJob)))
+
+
+async def save_talk_job(job: TalkJob) -> None:
+    """
+    Add or update a /talk loop.
+    """
+
+    return await run_in_db(_save_talk_job, job=job)
+
+
+def _save_talk_job(job: TalkJob) -> None:
+    _upsert(job)
+
+
+async def delete_talk_job(guild_id: int) -> None:
+    """
+    Remove a guild's /talk loop.
+    """
+
+    return await run_in_db(_delete_talk_job, guild_id=guild_id)
+
+
+def _delete_talk_job(guild_id: int) -> None:
+    with get_session() as session:
+        if job := session.get(TalkJob, guild_id):
+            session.delete(job)
+            session.commit()
+
+
+async def get_speech_clips() -> List[SpeechClip]:
+    """
+    Load the speech cache index, least recently used first.
+    """
+
+    return await run_in_db(_get_speech_clips)
+
+
+def _get_speech_clips() -> List[SpeechClip]:
+    with get_session() as session:
+        return list(session.exec(select(SpeechClip).order_by(SpeechClip.last_used)))
+
+
+async def save_speech_clip(clip: SpeechClip) -> None:
+    """
+    Add or refresh an entry in the speech cache index.
+    """
+
+    return await run_in_db(_save_speech_clip, clip=clip)
+
+
+def _save_speech_clip(clip: SpeechClip) -> None:
+    _upsert(clip)
+
+
+async def delete_speech_clips(keys: List[str]) -> None:
+    """
+    Remove evicted entries from the speech cache index.
+    """
+
+    return await run_in_db(_delete_speech_clips, keys=keys)
+
+
+def _delete_speech_clips(keys: List[str]) -> None:
+    with get_session() as session:
+        for clip in session.exec(select(SpeechClip).where(SpeechClip.key.in_(keys))):
+            session.delete(clip)
+        session.commit()
+
+
+async def save_artifacts(artifacts: List[Artifact]) -> None:
+    """
+    Add or refresh entries in the generated content index.
+    """
+
+    return await run_in_db(_save_artifacts, artifacts=artifacts)
+
+
+def _save_artifacts(artifacts: List[Artifact]) -> None:
+    # the first index of an existing tree can be thousands of rows, so insert them in batches
+    with get_session() as session:
+        for start in range(0, len(artifacts), ARTIFACT_BATCH_SIZE):
+            statement = insert(Artifact.__table__).values(
+                [artifact.model_dump() for artifact in artifacts[start : start + ARTIFACT_BATCH_SIZE]]
+            )
+            session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["path"],
+                    set_={"size": statement.excluded.size, "created": statement.excluded.created},
+                )
+            )
+        session.commit()
+
+
+async def get_artifacts(
+    guild_id: Optional[int] = None, created_before: Optional[datetime] = None, suffix: Optional[str] = None
+) -> List[Artifact]:
+    """
+    Look up indexed content, oldest first, optionally for one guild, before a time, or with a file suffix.
+    """
+
+    return await run_in_db(_get_artifacts, guild_id=guild_id, created_before=created_before, suffix=suffix)
+
+
+def _get_artifacts(
+    guild_id: Optional[int], created_before: Optional[datetime], suffix: Optional[str]
+) -> List[Artifact]:
+    statement = select(Artifact).order_by(Artifact.created)
+    if guild_id is not None:
+        statement = statement.where(Artifact.guild_id == guild_id)
+    if created_before is not None:
+        statement = statement.where(Artifact.created < created_before)
+    if suffix is not None:
+        statement = statement.where(Artifact.path.endswith(suffix))
+
+    with get_session() as session:
+        return list(session.exec(statement))
+
+
+async def get_artifact_usage() -> Dict[int, Tuple[int, int]]:
+    """
+    Return each guild's number of indexed files and their total size in bytes.
+    """
+
+    return await run_in_db(_get_artifact_usage)
+
+
+def _get_artifact_usage() -> Dict[int, Tuple[int, int]]:
+    statement = select(Artifact.guild_id, sql_func.count(), sql_func.sum(Artifact.size)).group_by(Artifact.guild_id)
+
+    with get_session() as session:
+        return {guild_id: (count, size or 0) for guild_id, count, size in session.exec(statement)}
+
+
+async def delete_artifacts(paths: List[str]) -> None:
+    """
+    Remove deleted files from the generated content index.
+    """
+
+    return await run_in_db(_delete_artifacts, paths=paths)
+
+
+def _delete_artifacts(paths: List[str]) -> None:
+    with get_session() as session:
+        for start in range(0, len(paths), ARTIFACT_BATCH_SIZE):
+            session.execute(delete(Artifact).where(Artifact.path.in_(paths[start : start + ARTIFACT_BATCH_SIZE])))
+        session.commit()
+
+
+async def get_content_scan(root: str) -> Optional[datetime]:
+    """
+    Return when a content directory's existing files were indexed, if they ever were.
+    """
+
+    return await run_in_db(_get_content_scan, root=root)
+
+
+def _get_content_scan(root: str) -> Optional[datetime]:
+    with get_session() as session:
+        content_scan = session.get(ContentScan, root)
+        return content_scan.finished if content_scan else None
+
+
+async def save_content_scan(root: str) -> None:
+    """
+    Remember that a content directory's existing files have been indexed.
+    """
+
+    return await run_in_db(_upsert, ContentScan(root=root))
+
+
+async def get_command_fingerprint(scope: str) -> Optional[str]:
+    """
+    Return the fingerprint of the slash commands last synced to a scope, if they ever were.
+    """
+
+    return await run_in_db(_get_command_fingerprint, scope=scope)
+
+
+def _get_command_fingerprint(scope: str) -> Optional[str]:
+    with get_session() as session:
+        command_sync = session.get(CommandSync, scope)
+        return command_sync.fingerprint if command_sync else None
+
+
+async def save_command_fingerprint(scope: str, fingerprint: str) -> None:
+    """
+    Remember the fingerprint of the slash commands just synced to a scope.
+    """
+
+    return await run_in_db(_upsert, CommandSync(scope=scope, fingerprint=fingerprint))
+
+
+async def increment_usage(model: str, period: str, limits: Dict[str, int]) -> Tuple[Optional[str], Dict[str, int]]:
+    """
+    Count one use of a model against every scope's limit in a single transaction.
+    Returns the first scope that is already at its limit (in which case nothing is counted) and the new counts.
+    """
+
+    return await run_in_db(_increment_usage, model=model, period=period, limits=limits)
+
+
+def _increment_usage(model: str, period: str, limits: Dict[str, int]) -> Tuple[Optional[str], Dict[str, int]]:
+    counts = {}
+
+    with get_session() as session:
+        for scope, limit in limits.items():
+            counted = session.execute(
+                INCREMENT_USAGE, {"scope": scope, "model": model, "period": period, "limit": limit}
+            ).first()
+            if counted is None:
+                session.rollback()
+                return scope, {}
+            counts[scope] = counted[0]
+        session.commit()
+
+    return None, counts
 
 
 if __name__ == "__main__":
-    SQLModel.metadata.create_all(engine)
+    init_db()
 
     with get_session() as db_session:
         with open("encrypted_api_keys.txt", mode="r", encoding="UTF-8") as f:
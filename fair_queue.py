@@ -0,0 +1,175 @@
+"""
+Fair sharing of OpenAI request slots between guilds, so one busy server can't starve the rest
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+# how often a waiting request re-reports its place in line
+QUEUE_REPORT_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+# set by a command to hear where its requests are in the queue; called with None once they're running
+queue_listener: ContextVar[Optional[Callable[[Optional[int]], Awaitable[None]]]] = ContextVar(
+    "queue_listener", default=None
+)
+
+openai_queue_stats: Dict[str, float] = {
+    "granted": 0,
+    "queued": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+    "api_seconds_total": 0.0,
+    "api_seconds_max": 0.0,
+}
+
+
+@dataclass
+class _Waiter:
+    guild_id: int
+    tag: float
+    future: "asyncio.Future[None]"
+    enqueued: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class _GuildState:
+    active: int = 0
+    # the virtual time at which the guild's most recently queued request finishes
+    finish: float = 0.0
+    waiting: Deque[_Waiter] = field(default_factory=deque)
+
+
+class FairScheduler:
+    """
+    Hands out at most global_limit concurrent request slots, and at most guild_limit to any one guild.
+    Waiting requests are served in start-time fair queuing order: each is tagged with
+    max(virtual time, its guild's last finish tag), a guild's finish tag advances by 1 / weight per request,
+    and the lowest tag runs next. A guild with weight 2 gets twice the share of a guild with weight 1.
+    """
+
+    def __init__(self, global_limit: int = 16, guild_limit: int = 4) -> None:
+        self.global_limit = global_limit
+        self.guild_limit = guild_limit
+        self.weights: Dict[int, float] = {}
+        self._guilds: Dict[int, _GuildState] = {}
+        self._active = 0
+        self._virtual_time = 0.0
+
+    @property
+    def active(self) -> int:
+        """
+        The number of slots in use
+        """
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        """
+        The number of requests waiting for a slot
+        """
+        return sum(len(state.waiting) for state in self._guilds.values())
+
+    def position(self, waiter: _Waiter) -> int:
+        """
+        How many waiting requests are ahead of this one
+        """
+        return sum(1 for state in self._guilds.values() for other in state.waiting if other.tag < waiter.tag)
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int) -> AsyncIterator[None]:
+        """
+        Wait for the guild's turn and hold a request slot for the duration of the block
+        """
+        await self._acquire(guild_id)
+        try:
+            yield
+        finally:
+            self._release(guild_id)
+
+    async def _acquire(self, guild_id: int) -> None:
+        state = self._guilds.setdefault(guild_id, _GuildState())
+        tag = max(self._virtual_time, state.finish)
+        state.finish = tag + 1.0 / self.weights.get(guild_id, 1.0)
+
+        waiter = _Waiter(guild_id=guild_id, tag=tag, future=asyncio.get_running_loop().create_future())
+        state.waiting.append(waiter)
+        self._dispatch()
+
+        if waiter.future.done():
+            openai_queue_stats["granted"] += 1
+            return
+
+        openai_queue_stats["queued"] += 1
+        listener = queue_listener.get()
+        reported = None
+
+        try:
+            while not waiter.future.done():
+                if listener and (position := self.position(waiter)) != reported:
+                    reported = position
+                    await listener(position)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=QUEUE_REPORT_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+            if listener:
+                await listener(None)
+        except BaseException:
+            # hand the slot back if it was granted just as we gave up, otherwise leave the line
+            if waiter.future.done():
+                self._release(guild_id)
+            else:
+                state.waiting.remove(waiter)
+                waiter.future.cancel()
+            raise
+
+        wait = time.monotonic() - waiter.enqueued
+        openai_queue_stats["granted"] += 1
+        openai_queue_stats["wait_seconds_total"] += wait
+        openai_queue_stats["wait_seconds_max"] = max(openai_queue_stats["wait_seconds_max"], wait)
+
+    def _release(self, guild_id: int) -> None:
+        state = self._guilds[guild_id]
+        state.active -= 1
+        self._active -= 1
+
+        # an idle guild that isn't ahead of anyone is the same as a new one
+        if not state.active and not state.waiting and state.finish <= self._virtual_time:
+            del self._guilds[guild_id]
+
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._active < self.global_limit:
+            candidates = [
+                state for state in self._guilds.values() if state.waiting and state.active < self.guild_limit
+            ]
+            if not candidates:
+                return
+
+            state = min(candidates, key=lambda state: state.waiting[0].tag)
+            waiter = state.waiting.popleft()
+            state.active += 1
+            self._active += 1
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            waiter.future.set_result(None)
+
+
+openai_scheduler = FairScheduler()
+
+
+def record_api_time(seconds: float) -> None:
+    """
+    Count time spent waiting on OpenAI itself, as opposed to waiting in the queue
+    """
+    openai_queue_stats["api_seconds_total"] += seconds
+    openai_queue_stats["api_seconds_max"] = max(openai_queue_stats["api_seconds_max"], seconds)
@@ -0,0 +1,49 @@
+"""
+Run the bot as several processes, each owning a slice of the shards
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+
+
+def main() -> None:
+    """
+    Spawn one app.py process per slice of shards and wait for them
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", type=int, required=True, help="The total number of shards across all processes.")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="How many bot processes to spread the shards over."
+    )
+    args = parser.parse_args()
+
+    processes = min(args.processes, args.shards)
+    children = []
+
+    for index in range(processes):
+        shard_ids = range(index, args.shards, processes)
+        env = {**os.environ, "SHARD_COUNT": str(args.shards), "SHARD_IDS": ",".join(map(str, shard_ids))}
+        children.append(subprocess.Popen([sys.executable, "app.py"], env=env))  # pylint: disable=R1732
+
+    # discord.py shuts down cleanly (flushing our buffers) on SIGINT, so that's what a stop request becomes
+    def stop(_signum, _frame) -> None:
+        for child in children:
+            child.send_signal(signal.SIGINT)
+
+    def reload(_signum, _frame) -> None:
+        for child in children:
+            child.send_signal(signal.SIGHUP)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload)
+
+    sys.exit(max(child.wait() for child in children))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+Prometheus-style metrics, per-command traces, and the HTTP endpoint they are scraped from
+"""
+
+import abc
+import asyncio
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_LAG_INTERVAL = 0.5
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: str) -> str:
+    # label values come from config and callers, so escape them the way the text format requires
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(abc.ABC):
+    """
+    A named family of samples, one per combination of label values
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def expose(self) -> List[str]:
+        """
+        Render the metric in the Prometheus text format
+        """
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        pass
+
+
+class Counter(Metric):
+    """
+    A value that only goes up
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        """
+        Add to the counter
+        """
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        """
+        Set the gauge
+        """
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets, with their sum and count
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """
+        Record an observation
+        """
+        key = self._key(labels)
+        counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._values[key] = (counts, total + value, count + 1)
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            samples.append(f"{self.name}_bucket{labels} {count}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return samples
+
+
+class Registry:
+    """
+    Every metric the process exports, plus the plain stats dicts other modules already keep
+    """
+
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        """
+        Create and register a counter
+        """
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        """
+        Create and register a gauge
+        """
+        metric = Gauge(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        """
+        Create and register a histogram
+        """
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_stats(self, name: str, stats: Dict[str, float]) -> None:
+        """
+        Export a module's stats dict, one untyped metric per key, read at scrape time
+        """
+        self._stats[name] = stats
+
+    def expose(self) -> str:
+        """
+        Render everything in the Prometheus text format
+        """
+        lines = [line for metric in self._metrics for line in metric.expose()]
+        for name, stats in self._stats.items():
+            for key, value in stats.items():
+                metric = f"discord_bot_{name}_{key}"
+                lines += [f"# HELP {metric} {key} from the {name} stats.", f"# TYPE {metric} untyped"]
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+COMMANDS = registry.counter("discord_bot_commands_total", "Commands handled.", ("command", "guild", "outcome"))
+COMMAND_SECONDS = registry.histogram("discord_bot_command_seconds", "Command handler duration.", ("command", "guild"))
+SPAN_SECONDS = registry.histogram(
+    "discord_bot_span_seconds", "Time spent in each step of a command.", ("span", "command", "guild", "model")
+)
+LOOP_LAG_SECONDS = registry.histogram(
+    "discord_bot_event_loop_lag_seconds", "How late the event loop woke from a sleep.", buckets=LOOP_LAG_BUCKETS
+)
+
+
+@dataclass
+class Trace:
+    """
+    The steps one command invocation went through and how long each took
+    """
+
+    command: str
+    guild_id: Optional[int]
+    started: float = field(default_factory=time.perf_counter)
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+    # set once the command returns; tasks it left running still see the trace but mustn't add to it
+    finished: bool = False
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def observe_span(name: str, seconds: float, model: str = "") -> None:
+    """
+    Record a step that was timed elsewhere against the current command
+    """
+    trace = _trace.get()
+    if trace and trace.finished:
+        trace = None
+    SPAN_SECONDS.observe(
+        seconds,
+        span=name,
+        command=trace.command if trace else "",
+        guild=trace.guild_id if trace else "",
+        model=model,
+    )
+    if trace:
+        trace.spans.append((name, seconds))
+
+
+@contextmanager
+def span(name: str, model: str = "") -> Iterator[None]:
+    """
+    Time a step of the current command
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - started, model=model)
+
+
+def traced(name: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Decorate a coroutine function so every call is recorded as a span
+    """
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_command(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """
+    Count and time a slash command handler, and log the steps it spent its time on
+    """
+
+    @functools.wraps(func)
+    async def wrapper(interaction: Any, *args: Any, **kwargs: Any) -> T:
+        trace = Trace(command=func.__name__, guild_id=interaction.guild_id)
+        token = _trace.set(trace)
+        outcome = "error"
+
+        try:
+            result = await func(interaction, *args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            trace.finished = True
+            _trace.reset(token)
+            elapsed = time.perf_counter() - trace.started
+            COMMANDS.inc(command=trace.command, guild=trace.guild_id, outcome=outcome)
+            COMMAND_SECONDS.observe(elapsed, command=trace.command, guild=trace.guild_id)
+            logger.info(
+                "/%s in guild %s: %s in %.2fs (%s)",
+                trace.command,
+                trace.guild_id,
+                outcome,
+                elapsed,
+                ", ".join(f"{name} {seconds:.2f}s" for name, seconds in trace.spans) or "no spans",
+            )
+
+    return wrapper
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """
+    Measure how late the event loop wakes up from a short sleep, forever
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def _serve_metrics(_request: web.Request) -> web.Response:
+    return web.Response(text=registry.expose(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Serve GET /metrics for Prometheus to scrape
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _serve_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,269 @@
+"""
+A local stand-in for the parts of the OpenAI API the bot uses, with adjustable latency and injected errors.
+Run it on its own with `python mock_openai.py --port 8765` and point OPENAI_BASE_URL at http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import math
+import random
+import struct
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+# relative time to first byte of each endpoint, as a multiple of --latency-ms
+ENDPOINT_LATENCY = {"responses": 1.0, "speech": 0.5, "images": 5.0}
+
+SPEECH_SAMPLE_RATE = 24000
+SPEECH_SECONDS_PER_CHAR = 0.06
+SPEECH_CHUNK_BYTES = 4800
+
+LOREM = (
+    "would you rather fight one horse sized duck or a hundred duck sized horses while reciting every line "
+    "of your favourite movie backwards in a crowded room full of people who have seen it twice"
+).split()
+
+
+@dataclass
+class MockOptions:
+    """
+    How the mock API behaves
+    """
+
+    latency_ms: float = 200.0
+    # per-token delay of streamed text, and how much faster than real time speech is produced
+    token_ms: float = 15.0
+    speech_realtime_factor: float = 5.0
+    output_words: int = 60
+    image_bytes: int = 1024 * 1024
+    # the chance a request fails with a 429 or a 500, and the chance it takes 10 times as long
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+
+
+class MockOpenAI:
+    """
+    Serves /v1/responses (plain and streamed), /v1/audio/speech and /v1/images/generations
+    """
+
+    def __init__(self, options: MockOptions) -> None:
+        self.options = options
+        self.ids = itertools.count(1)
+        # response id -> total tokens, so chained responses grow the way they do upstream
+        self.context_tokens: Dict[str, int] = {}
+        self.requests: Dict[str, int] = {"responses": 0, "speech": 0, "images": 0, "errors": 0}
+        self.image_b64 = base64.b64encode(random.randbytes(options.image_bytes)).decode()
+        # one second of a quiet 220Hz tone, repeated for as long as the speech needs
+        self.tone = b"".join(
+            struct.pack("<h", int(3000 * math.sin(2 * math.pi * 220 * n / SPEECH_SAMPLE_RATE)))
+            for n in range(SPEECH_SAMPLE_RATE)
+        )
+
+    def app(self) -> web.Application:
+        """
+        Build the aiohttp application
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/responses", self.responses)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_post("/v1/images/generations", self.images)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def _delay(self, endpoint: str) -> Optional[web.Response]:
+        """
+        Wait out the endpoint's latency, or return an error response to send instead
+        """
+        self.requests[endpoint] += 1
+        latency = random.expovariate(1.0) * self.options.latency_ms * ENDPOINT_LATENCY[endpoint] / 1000
+        if random.random() < self.options.slow_rate:
+            latency *= 10
+        await asyncio.sleep(latency)
+
+        if random.random() < self.options.error_rate:
+            self.requests["errors"] += 1
+            if random.random() < 0.5:
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                    status=429,
+                    headers={"retry-after-ms": "250"},
+                )
+            return web.json_response(
+                {"error": {"message": "The server had an error", "type": "server_error"}}, status=500
+            )
+
+        return None
+
+    def _response(self, request: Dict[str, Any], text: str) -> Dict[str, Any]:
+        response_id = f"resp_{next(self.ids)}"
+        input_tokens = (
+            self.context_tokens.get(request.get("previous_response_id") or "", 0)
+            + len(json.dumps(request.get("input"))) // 4
+            + len(request.get("instructions") or "") // 4
+        )
+        output_tokens = len(text) // 4
+        self.context_tokens[response_id] = input_tokens + output_tokens
+
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": time.time(),
+            "status": "completed",
+            "model": request.get("model"),
+            "previous_response_id": request.get("previous_response_id"),
+            "instructions": request.get("instructions"),
+            "max_output_tokens": request.get("max_output_tokens"),
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "error": None,
+            "incomplete_details": None,
+            "output": [
+                {
+                    "type": "message",
+                    "id": f"msg_{response_id}",
+                    "status": "completed",
+                    "role": "assistant",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}],
+                }
+            ],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    async def responses(self, request: web.Request) -> web.StreamResponse:
+        """
+        POST /v1/responses
+        """
+        body = await request.json()
+        if error := await self._delay("responses"):
+            return error
+
+        words: List[str] = [random.choice(LOREM) for _ in range(self.options.output_words)]
+        text = " ".join(words).capitalize() + "?"
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) * self.options.token_ms / 1000)
+            return web.json_response(self._response(body, text))
+
+        stream = web.StreamResponse(headers={"content-type": "text/event-stream"})
+        await stream.prepare(request)
+        sequence = itertools.count()
+
+        async def send(event: Dict[str, Any]) -> None:
+            event["sequence_number"] = next(sequence)
+            await stream.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+
+        for index, word in enumerate(words):
+            await asyncio.sleep(self.options.token_ms / 1000)
+            await send(
+                {
+                    "type": "response.output_text.delta",
+                    "item_id": "msg",
+                    "output_index": 0,
+                    "content_index": 0,
+                    "delta": word if index == 0 else f" {word}",
+                    "logprobs": [],
+                }
+            )
+
+        await send({"type": "response.completed", "response": self._response(body, " ".join(words))})
+        await stream.write_eof()
+        return stream
+
+    async def speech(self, request: web.Request) -> web.StreamResponse:
+        """
+        POST /v1/audio/speech, always answering with 24kHz 16-bit mono PCM
+        """
+        body = await request.json()
+        if error := await self._delay("speech"):
+            return error
+
+        seconds = max(0.2, len(body.get("input", "")) * SPEECH_SECONDS_PER_CHAR)
+        pcm = (self.tone * math.ceil(seconds))[: int(seconds * SPEECH_SAMPLE_RATE) * 2]
+
+        stream = web.StreamResponse(headers={"content-type": "audio/pcm"})
+        await stream.prepare(request)
+        chunk_seconds = SPEECH_CHUNK_BYTES / 2 / SPEECH_SAMPLE_RATE / self.options.speech_realtime_factor
+        for start in range(0, len(pcm), SPEECH_CHUNK_BYTES):
+            await stream.write(pcm[start : start + SPEECH_CHUNK_BYTES])
+            await asyncio.sleep(chunk_seconds)
+        await stream.write_eof()
+        return stream
+
+    async def images(self, request: web.Request) -> web.Response:
+        """
+        POST /v1/images/generations
+        """
+        body = await request.json()
+        if error := await self._delay("images"):
+            return error
+
+        return web.json_response(
+            {
+                "created": int(time.time()),
+                "data": [{"b64_json": self.image_b64, "revised_prompt": body.get("prompt")}],
+            }
+        )
+
+    async def stats(self, _request: web.Request) -> web.Response:
+        """
+        GET /stats, the number of requests served per endpoint
+        """
+        return web.json_response(self.requests)
+
+
+def run(port: int, options: MockOptions) -> None:
+    """
+    Serve the mock API until interrupted
+    """
+    # benchmark clients hang up mid-response all the time; that's not worth a traceback
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    web.run_app(MockOpenAI(options).app(), host="127.0.0.1", port=port, print=None, handle_signals=True)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the mock's behaviour options to an argument parser
+    """
+    defaults = MockOptions()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="Mean time to first byte.")
+    parser.add_argument("--token-ms", type=float, default=defaults.token_ms, help="Delay between streamed words.")
+    parser.add_argument("--output-words", type=int, default=defaults.output_words, help="Words per response.")
+    parser.add_argument("--image-kb", type=int, default=defaults.image_bytes // 1024, help="Generated image size.")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Share of 429/500 replies.")
+    parser.add_argument("--slow-rate", type=float, default=defaults.slow_rate, help="Share of 10x slow replies.")
+
+
+def options_from(args: argparse.Namespace) -> MockOptions:
+    """
+    Build MockOptions from parsed arguments
+    """
+    return MockOptions(
+        latency_ms=args.latency_ms,
+        token_ms=args.token_ms,
+        output_words=args.output_words,
+        image_bytes=args.image_kb * 1024,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serve a mock OpenAI API for benchmarking.")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    add_arguments(arg_parser)
+    cli_args = arg_parser.parse_args()
+    run(port=cli_args.port, options=options_from(cli_args))
@@ -0,0 +1,260 @@
+"""
+Timeouts, retries, circuit breaking and hedging for OpenAI API calls
+"""
+
+import asyncio
+import logging
+import random
+import time
+from functools import partial
+from typing import Awaitable, Callable, Dict, Optional, Set, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+
+# rate limits, timeouts, dropped connections and 5xx responses are worth another try; other errors are not
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+logger = logging.getLogger(__name__)
+openai_request_stats: Dict[str, int] = {
+    "requests": 0,
+    "attempts": 0,
+    "retries": 0,
+    "timeouts": 0,
+    "failures": 0,
+    "rejected": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+}
+
+# hedged results that lost the race and still need closing
+_discarding: Set[asyncio.Task] = set()
+
+
+class OpenAIUnavailable(Exception):
+    """
+    Raised when a guild's OpenAI requests keep failing, or are paused by its circuit breaker
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops sending a guild's requests for a while after too many consecutive failures,
+    then lets a single probe through to find out whether the API has recovered
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self._opened: Optional[float] = None
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        """
+        "closed" while requests flow, "open" while they're refused, "half-open" once a probe is allowed
+        """
+        if self._opened is None:
+            return "closed"
+        return "half-open" if self.retry_after() == 0 else "open"
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the breaker lets another request through
+        """
+        if self._opened is None:
+            return 0.0
+        return max(0.0, self._opened + self.reset_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now
+        """
+        if self._opened is None:
+            return True
+        if self.retry_after() > 0:
+            return False
+
+        # one probe at a time; a probe that never reported back is given up on after reset_seconds
+        now = time.monotonic()
+        if self._probe_started is not None and now - self._probe_started < self.reset_seconds:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self) -> None:
+        """
+        Close the breaker
+        """
+        self.failures = 0
+        self._opened = None
+        self._probe_started = None
+
+    def record_failure(self) -> None:
+        """
+        Count a failure, opening (or re-opening) the breaker at the threshold
+        """
+        self.failures += 1
+        self._probe_started = None
+        if self.failures >= self.failure_threshold:
+            self._opened = time.monotonic()
+
+
+_breakers: Dict[int, CircuitBreaker] = {}
+
+
+def get_breaker(guild_id: int, failure_threshold: int, reset_seconds: float) -> CircuitBreaker:
+    """
+    Return the guild's circuit breaker, creating it on first use and keeping its thresholds current
+    """
+    if guild_id not in _breakers:
+        _breakers[guild_id] = CircuitBreaker(failure_threshold=failure_threshold, reset_seconds=reset_seconds)
+
+    breaker = _breakers[guild_id]
+    breaker.failure_threshold = failure_threshold
+    breaker.reset_seconds = reset_seconds
+    return breaker
+
+
+def retry_delay(attempt: int, error: BaseException) -> float:
+    """
+    How long to wait before trying again: the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                return min(float(response.headers["retry-after-ms"]) / 1000, RETRY_MAX_DELAY)
+            if "retry-after" in response.headers:
+                return min(float(response.headers["retry-after"]), RETRY_MAX_DELAY)
+        except ValueError:
+            # an HTTP date rather than a number of seconds
+            pass
+
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+def _discard(discard: Optional[Callable[[T], Awaitable[None]]], task: "asyncio.Future[T]") -> None:
+    if task.cancelled() or task.exception() is not None or not discard:
+        return
+
+    cleanup = asyncio.create_task(discard(task.result()))
+    _discarding.add(cleanup)
+    cleanup.add_done_callback(_discarding.discard)
+
+
+async def _hedged(
+    make_request: Callable[[], Awaitable[T]],
+    hedge_after: float,
+    discard: Optional[Callable[[T], Awaitable[None]]],
+) -> T:
+    """
+    Send a second copy of a request if the first is slow, and keep whichever answers first
+    """
+    first = asyncio.ensure_future(make_request())
+    pending = {first}
+
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        openai_request_stats["hedges"] += 1
+        second = asyncio.ensure_future(make_request())
+        pending.add(second)
+        error: Optional[BaseException] = None
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+
+            # both can finish in the same tick; the spare needs closing too
+            for task in winners[1:]:
+                _discard(discard, task)
+
+            if winners:
+                if winners[0] is second:
+                    openai_request_stats["hedge_wins"] += 1
+                return winners[0].result()
+
+            error = next(iter(done)).exception()
+
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(partial(_discard, discard))
+
+
+async def call_with_retries(
+    make_request: Callable[[], Awaitable[T]],
+    breaker: CircuitBreaker,
+    timeout: float,
+    retries: int,
+    hedge_after: Optional[float] = None,
+    discard: Optional[Callable[[T], Awaitable[None]]] = None,
+    description: str = "OpenAI request",
+) -> T:
+    """
+    Await make_request() with a timeout per attempt, retrying transient failures with backoff
+    and failing fast while the breaker is open. make_request must build a fresh request on every call.
+    If hedge_after is set, an attempt that takes longer than that is raced against a duplicate,
+    and discard is used to release the slower one's result.
+    """
+    openai_request_stats["requests"] += 1
+
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            openai_request_stats["rejected"] += 1
+            raise OpenAIUnavailable(
+                f"{description} is paused after repeated failures.", retry_after=breaker.retry_after()
+            )
+
+        openai_request_stats["attempts"] += 1
+        try:
+            async with asyncio.timeout(timeout):
+                if hedge_after:
+                    result = await _hedged(make_request=make_request, hedge_after=hedge_after, discard=discard)
+                else:
+                    result = await make_request()
+        except RETRYABLE_ERRORS as error:
+            breaker.record_failure()
+            if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError)):
+                openai_request_stats["timeouts"] += 1
+
+            delay = retry_delay(attempt=attempt, error=error)
+            if attempt == retries or breaker.state == "open":
+                openai_request_stats["failures"] += 1
+                raise OpenAIUnavailable(
+                    f"{description} failed after {attempt + 1} attempts: {error!r}",
+                    retry_after=max(delay, breaker.retry_after()),
+                ) from error
+
+            logger.warning("%s failed (%r); retrying in %.1f seconds", description, error, delay)
+            openai_request_stats["retries"] += 1
+            await asyncio.sleep(delay)
+        except openai.APIStatusError:
+            # the API answered, it just didn't like the request
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+    raise AssertionError("unreachable")
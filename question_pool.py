@@ -0,0 +1,141 @@
+"""
+Pools of pre-generated questions (text and audio) so /rather can answer without waiting on OpenAI
+"""
+
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Optional, Tuple
+
+from ai_helpers import get_settings, speak_and_spell
+from audio_helpers import SpeechStream
+from db_utils import CommandContext
+
+logger = logging.getLogger(__name__)
+question_pool_stats: Dict[str, int] = {"hits": 0, "waits": 0, "misses": 0, "generated": 0, "failures": 0}
+
+
+class QuestionPool:
+    """
+    Keeps up to `size` questions for one guild and topic ready to go, topping itself up in the background.
+    Every question, pooled or not, is generated one at a time so the conversation chain stays linear.
+    """
+
+    def __init__(self, guild_id: int, topic: str) -> None:
+        self.guild_id = guild_id
+        self.topic = topic
+        self._ready: Deque[Tuple[str, Path]] = deque()
+        self._changed = asyncio.Condition()
+        self._generating = asyncio.Lock()
+        self._filler: Optional[asyncio.Task] = None
+        self._filling = False
+        # the most recent command context, used to attribute background generations
+        self._context: Optional[CommandContext] = None
+
+    @property
+    def size(self) -> int:
+        """
+        How many questions to keep ready, from the config ini
+        """
+        return get_settings().rather_pool_size
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of questions ready to be taken
+        """
+        return len(self._ready)
+
+    async def take(self, context: CommandContext) -> Optional[Tuple[str, Path]]:
+        """
+        Return a ready question, waiting for one that's already being generated,
+        or None if the pool is empty and the caller should generate one itself with `generate`.
+        """
+        self._context = context
+
+        async with self._changed:
+            if not self._ready and self._filling:
+                question_pool_stats["waits"] += 1
+                await self._changed.wait_for(lambda: self._ready or not self._filling)
+
+            # the content store may have evicted a question that sat in the pool for a long time
+            while self._ready and not self._ready[0][1].exists():
+                self._ready.popleft()
+
+            question = self._ready.popleft() if self._ready else None
+
+        if question:
+            question_pool_stats["hits"] += 1
+        else:
+            question_pool_stats["misses"] += 1
+
+        return question
+
+    async def generate(self, stream: Optional[SpeechStream] = None) -> Tuple[str, Path]:
+        """
+        Generate a question right now, e.g. when the pool ran dry, feeding its speech to the stream if given
+        """
+        if not self._context:
+            raise RuntimeError("The pool needs a command context before it can generate questions.")
+
+        async with self._generating:
+            # keep_chatting chains each question onto the last so the model knows what it has already asked
+            context = CommandContext(
+                guild_id=self.guild_id,
+                user_id=self._context.user_id,
+                user=self._context.user,
+                command_name=self._context.command_name,
+                params={"topic": self.topic, "keep_chatting": True},
+            )
+            question = await speak_and_spell(
+                context=context, prompt=get_settings().prompts["new_hypothetical"], stream=stream
+            )
+
+        question_pool_stats["generated"] += 1
+        return question
+
+    def refill(self) -> None:
+        """
+        Start topping the pool up in the background if it isn't full
+        """
+        if self.size <= 0 or not self._context or self._filling or self.depth >= self.size:
+            return
+
+        # run in a fresh context: the command that started the refill isn't waiting on it or tracing it
+        self._filling = True
+        self._filler = asyncio.create_task(
+            self._fill(), name=f"question-pool-{self.guild_id}-{self.topic}", context=contextvars.Context()
+        )
+
+    async def _fill(self) -> None:
+        try:
+            while self.depth < self.size:
+                try:
+                    question = await self.generate()
+                except Exception:  # pylint: disable=W0718
+                    question_pool_stats["failures"] += 1
+                    logger.exception("Could not refill the %s question pool for guild %s", self.topic, self.guild_id)
+                    return
+
+                async with self._changed:
+                    self._ready.append(question)
+                    self._changed.notify_all()
+        finally:
+            # wake anyone waiting on a question that is no longer coming
+            async with self._changed:
+                self._filling = False
+                self._changed.notify_all()
+
+
+_pools: Dict[Tuple[int, str], QuestionPool] = {}
+
+
+def get_question_pool(guild_id: int, topic: str) -> QuestionPool:
+    """
+    Return the guild's pool for a topic, creating it on first use
+    """
+    if (guild_id, topic) not in _pools:
+        _pools[(guild_id, topic)] = QuestionPool(guild_id=guild_id, topic=topic)
+    return _pools[(guild_id, topic)]
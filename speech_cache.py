@@ -0,0 +1,104 @@
+"""
+A content-addressed cache of generated speech so repeated utterances don't cost another API call
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from db_utils import SpeechClip, delete_speech_clips, get_speech_clips, save_speech_clip
+
+CACHE_DIR = Path("generated_content/speech_cache")
+
+# key -> SpeechClip, least recently used first. Loaded from the database on first use.
+_index: Optional["OrderedDict[str, SpeechClip]"] = None
+_index_lock = asyncio.Lock()
+speech_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def speech_cache_key(text: str, voice: str, speech_model: str, audio_format: str = "wav") -> str:
+    """
+    Hash everything that determines the generated audio
+    """
+    return hashlib.sha256("\0".join((speech_model, voice, audio_format, text)).encode()).hexdigest()
+
+
+async def _get_index() -> "OrderedDict[str, SpeechClip]":
+    global _index  # pylint: disable=W0603
+
+    async with _index_lock:
+        if _index is None:
+            clips = await get_speech_clips()
+            _index = OrderedDict((clip.key, clip) for clip in clips)
+            speech_cache_stats["bytes"] = sum(clip.size for clip in clips)
+
+    return _index
+
+
+async def lookup_speech(key: str) -> Optional[Path]:
+    """
+    Return the cached audio file for a key, if there is one
+    """
+    index = await _get_index()
+    clip = index.get(key)
+
+    if not clip or not Path(clip.path).exists():
+        speech_cache_stats["misses"] += 1
+        return None
+
+    speech_cache_stats["hits"] += 1
+    index.move_to_end(key)
+    clip.hits += 1
+    clip.last_used = datetime.now()
+    await save_speech_clip(clip)
+
+    return Path(clip.path)
+
+
+def _link_or_copy(source: Path, destination: Path) -> int:
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    destination.unlink(missing_ok=True)
+
+    # a hard link costs no extra disk; fall back to a copy across filesystems
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+    return destination.stat().st_size
+
+
+async def store_speech(key: str, file_path: Path, max_bytes: int) -> None:
+    """
+    Add a freshly generated audio file to the cache, evicting the least recently used clips past max_bytes
+    """
+    if max_bytes <= 0:
+        return
+
+    index = await _get_index()
+    cache_path = CACHE_DIR / f"{key}.wav"
+    size = await asyncio.to_thread(_link_or_copy, file_path, cache_path)
+
+    if old_clip := index.pop(key, None):
+        speech_cache_stats["bytes"] -= old_clip.size
+
+    clip = SpeechClip(key=key, path=str(cache_path), size=size)
+    index[key] = clip
+    speech_cache_stats["bytes"] += size
+    await save_speech_clip(clip)
+
+    evicted = []
+    while speech_cache_stats["bytes"] > max_bytes and len(index) > 1:
+        _, old_clip = index.popitem(last=False)
+        speech_cache_stats["bytes"] -= old_clip.size
+        speech_cache_stats["evictions"] += 1
+        evicted.append(old_clip)
+
+    if evicted:
+        await asyncio.to_thread(lambda: [Path(old.path).unlink(missing_ok=True) for old in evicted])
+        await delete_speech_clips([old.key for old in evicted])
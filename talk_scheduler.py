@@ -0,0 +1,214 @@
+"""
+A single scheduler that owns every guild's /talk loop
+"""
+
+import asyncio
+import contextvars
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import discord
+
+from ai_helpers import get_settings, speak_and_spell
+from db_utils import CommandContext, TalkJob, delete_talk_job, get_talk_jobs, save_talk_job
+from voice_queue import PRIORITY_BACKGROUND, QUEUE_FULL_NOTE, queue_file
+
+logger = logging.getLogger(__name__)
+
+# timer actions, in the order they run when they fall due at the same moment
+PREFETCH = 0
+PLAY = 1
+
+
+class TalkScheduler:
+    """
+    Runs every guild's /talk loop from one timer queue. Each guild has at most one loop,
+    and its next utterance (text and audio) is generated ahead of its slot so it plays on time.
+    """
+
+    def __init__(self, bot: discord.Client) -> None:
+        self.bot = bot
+        self._jobs: Dict[int, TalkJob] = {}
+        # bumped whenever a guild's loop is started or stopped, so timers from an old loop are ignored
+        self._versions: Dict[int, int] = {}
+        self._timers: List[Tuple[float, int, int, int]] = []  # (when, action, guild_id, version)
+        self._prefetched: Dict[int, "asyncio.Task[Tuple[str, Path]]"] = {}
+        self._changed = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._playing: Set[asyncio.Task] = set()
+        self._loaded = False
+
+    def status(self, guild_id: int) -> Optional[TalkJob]:
+        """
+        Return the guild's running loop, if it has one
+        """
+        return self._jobs.get(guild_id)
+
+    async def start(self, job: TalkJob) -> bool:
+        """
+        Start a guild's loop, or replace the settings of the one it already has.
+        Returns True if an existing loop was replaced.
+        """
+        replaced = job.guild_id in self._jobs
+        self._forget(job.guild_id)
+        self._jobs[job.guild_id] = job
+        self._schedule(job)
+
+        if not self._runner or self._runner.done():
+            # outlives the command that started it, so it mustn't inherit that command's trace
+            self._runner = asyncio.create_task(self._run(), name="talk-scheduler", context=contextvars.Context())
+
+        await save_talk_job(job)
+        return replaced
+
+    async def stop(self, guild_id: int) -> bool:
+        """
+        Stop a guild's loop. Returns False if it didn't have one.
+        """
+        if guild_id not in self._jobs:
+            return False
+
+        self._forget(guild_id)
+        del self._jobs[guild_id]
+        await delete_talk_job(guild_id)
+        return True
+
+    async def load(self) -> None:
+        """
+        Resume the saved loops of the guilds this process serves, rejoining their voice channels
+        """
+        if self._loaded:
+            return
+        self._loaded = True
+
+        for job in await get_talk_jobs():
+            guild = self.bot.get_guild(job.guild_id)
+
+            # the guild belongs to another shard process
+            if not guild:
+                continue
+
+            if job.topic not in get_settings().prompts:
+                logger.warning("Dropping the talk loop of guild %s: no prompt for topic %r", job.guild_id, job.topic)
+                await delete_talk_job(job.guild_id)
+                continue
+
+            if not guild.voice_client:
+                channel = guild.get_channel(job.voice_channel_id)
+                if not isinstance(channel, discord.VoiceChannel):
+                    await delete_talk_job(job.guild_id)
+                    continue
+                try:
+                    await channel.connect()
+                except (discord.ClientException, discord.HTTPException, asyncio.TimeoutError):
+                    logger.warning("Could not rejoin voice in guild %s to resume its talk loop", job.guild_id)
+                    continue
+
+            job.next_run = max(job.next_run, datetime.now())
+            await self.start(job)
+
+    def _forget(self, guild_id: int) -> None:
+        self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+        if prefetch := self._prefetched.pop(guild_id, None):
+            prefetch.cancel()
+
+    def _schedule(self, job: TalkJob) -> None:
+        version = self._versions[job.guild_id]
+        due = job.next_run.timestamp()
+        lead = get_settings().talk_prefetch_seconds
+
+        heapq.heappush(self._timers, (due - lead, PREFETCH, job.guild_id, version))
+        heapq.heappush(self._timers, (due, PLAY, job.guild_id, version))
+        self._changed.set()
+
+    async def _run(self) -> None:
+        while True:
+            self._changed.clear()
+
+            if not self._timers:
+                await self._changed.wait()
+                continue
+
+            when, action, guild_id, version = self._timers[0]
+            if (delay := when - time.time()) > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._timers)
+            if self._versions.get(guild_id) != version or guild_id not in self._jobs:
+                continue
+
+            job = self._jobs[guild_id]
+
+            # the topic's prompt was removed from config.ini since the loop was started
+            if job.topic not in get_settings().prompts:
+                logger.warning("Dropping the talk loop of guild %s: no prompt for topic %r", guild_id, job.topic)
+                await self.stop(guild_id)
+                continue
+
+            if action == PREFETCH:
+                self._prefetch(job)
+            else:
+                task = asyncio.create_task(self._play(job, version), name=f"talk-{guild_id}")
+                self._playing.add(task)
+                task.add_done_callback(self._playing.discard)
+
+    def _prefetch(self, job: TalkJob) -> "asyncio.Task[Tuple[str, Path]]":
+        if job.guild_id not in self._prefetched:
+            context = CommandContext(
+                guild_id=job.guild_id,
+                user_id=job.user_id,
+                user=job.user,
+                command_name="talk",
+                params={"topic": f"talk_{job.topic}", "wait_minutes": job.interval / 60},
+            )
+            self._prefetched[job.guild_id] = asyncio.create_task(
+                speak_and_spell(context=context, prompt=get_settings().prompts[job.topic])
+            )
+        return self._prefetched[job.guild_id]
+
+    async def _play(self, job: TalkJob, version: int) -> None:
+        guild = self.bot.get_guild(job.guild_id)
+        voice = guild.voice_client if guild else None
+
+        # the loop ends with the voice connection, like it always has
+        if not voice or not voice.is_connected():
+            await self.stop(job.guild_id)
+            return
+
+        prefetch = self._prefetch(job)
+        del self._prefetched[job.guild_id]
+
+        # book the next slot now so a slow generation doesn't push the cadence back
+        job.next_run += timedelta(seconds=job.interval)
+        if job.next_run < datetime.now():
+            job.next_run = datetime.now() + timedelta(seconds=job.interval)
+        self._schedule(job)
+        await save_talk_job(job)
+
+        try:
+            tts, file_path = await prefetch
+        except asyncio.CancelledError:
+            return
+        except Exception:  # pylint: disable=W0718
+            logger.exception("Could not generate the next talk clip for guild %s", job.guild_id)
+            return
+
+        # the loop was stopped or replaced while we were generating
+        if self._versions.get(job.guild_id) != version:
+            return
+
+        if not queue_file(voice_client=voice, file_path=file_path, priority=PRIORITY_BACKGROUND):
+            tts = f"{tts}\n{QUEUE_FULL_NOTE}"
+
+        if channel := self.bot.get_channel(job.text_channel_id):
+            # a speech cache hit is named after its hash, so don't upload it under that
+            file_name = f"{job.topic}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}{file_path.suffix}"
+            await channel.send(content=tts, file=discord.File(fp=file_path, filename=file_name))
@@ -0,0 +1,206 @@
+"""
+A per-guild playback queue so voice clips wait their turn instead of colliding in voice_client.play
+"""
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from discord import AudioSource, VoiceClient
+
+from audio_helpers import SpeechStream, speech_source
+from metrics import registry
+
+# lower numbers play first
+PRIORITY_COMMAND = 0
+PRIORITY_BACKGROUND = 10
+
+MAX_QUEUE_DEPTH = 10
+QUEUE_FULL_NOTE = "-# The voice queue is full, so this one won't be read aloud."
+
+logger = logging.getLogger(__name__)
+voice_queue_stats: Dict[str, float] = {
+    # clips waiting to play across every guild
+    "depth": 0,
+    "enqueued": 0,
+    "played": 0,
+    "rejected": 0,
+    "skipped": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+VOICE_WAIT_SECONDS = registry.histogram(
+    "discord_bot_voice_queue_wait_seconds", "Time clips spent queued before playing.", ("guild",)
+)
+VOICE_QUEUE_DEPTH = registry.gauge("discord_bot_voice_queue_depth", "Clips waiting to play.", ("guild",))
+
+
+class VoiceQueueFull(Exception):
+    """
+    Raised when a guild already has as many clips queued as it is allowed
+    """
+
+
+@dataclass(order=True)
+class QueuedClip:
+    """
+    A clip waiting to be played. The source is only built when it's this clip's turn.
+    """
+
+    priority: int
+    sequence: int
+    voice_client: VoiceClient = field(compare=False)
+    make_source: Callable[[], AudioSource] = field(compare=False)
+    enqueued: float = field(compare=False, default_factory=time.monotonic)
+    # set once a live stream has audio; discord.py's player clock starts at play(), so don't call it any sooner
+    ready: Optional[asyncio.Event] = field(compare=False, default=None)
+
+
+class GuildAudioQueue:
+    """
+    Plays one guild's clips one at a time, in priority then arrival order
+    """
+
+    def __init__(self, guild_id: int, max_depth: int = MAX_QUEUE_DEPTH) -> None:
+        self.guild_id = guild_id
+        self.max_depth = max_depth
+        self._queue: "asyncio.PriorityQueue[QueuedClip]" = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of clips waiting to play
+        """
+        return self._queue.qsize()
+
+    def enqueue(
+        self,
+        voice_client: VoiceClient,
+        make_source: Callable[[], AudioSource],
+        priority: int = PRIORITY_COMMAND,
+        ready: Optional[asyncio.Event] = None,
+    ) -> int:
+        """
+        Queue a clip and return its position in line, or raise VoiceQueueFull so the caller can back off
+        """
+        if self.depth >= self.max_depth:
+            voice_queue_stats["rejected"] += 1
+            raise VoiceQueueFull(f"Guild {self.guild_id} already has {self.depth} clips queued.")
+
+        self._queue.put_nowait(
+            QueuedClip(
+                priority=priority,
+                sequence=next(self._sequence),
+                voice_client=voice_client,
+                make_source=make_source,
+                ready=ready,
+            )
+        )
+        voice_queue_stats["enqueued"] += 1
+        voice_queue_stats["depth"] += 1
+        VOICE_QUEUE_DEPTH.set(self.depth, guild=self.guild_id)
+
+        if not self._worker or self._worker.done():
+            # outlives the command that queued the first clip, so it mustn't inherit that command's trace
+            self._worker = asyncio.create_task(
+                self._play_forever(), name=f"voice-queue-{self.guild_id}", context=contextvars.Context()
+            )
+
+        return self.depth
+
+    def clear(self) -> None:
+        """
+        Drop everything that hasn't started playing yet
+        """
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            voice_queue_stats["skipped"] += 1
+            voice_queue_stats["depth"] -= 1
+        VOICE_QUEUE_DEPTH.set(0, guild=self.guild_id)
+
+    async def _play_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            clip = await self._queue.get()
+            voice_queue_stats["depth"] -= 1
+            VOICE_QUEUE_DEPTH.set(self.depth, guild=self.guild_id)
+
+            wait = time.monotonic() - clip.enqueued
+            voice_queue_stats["wait_seconds_total"] += wait
+            voice_queue_stats["wait_seconds_max"] = max(voice_queue_stats["wait_seconds_max"], wait)
+            VOICE_WAIT_SECONDS.observe(wait, guild=self.guild_id)
+
+            if clip.ready:
+                await clip.ready.wait()
+
+            if not clip.voice_client.is_connected():
+                voice_queue_stats["skipped"] += 1
+                continue
+
+            finished = loop.create_future()
+
+            # the after callback runs on discord.py's player thread
+            def after(error: Optional[Exception], finished: asyncio.Future = finished) -> None:
+                if error:
+                    logger.warning("Voice playback failed in guild %s: %s", self.guild_id, error)
+                loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+            try:
+                clip.voice_client.play(clip.make_source(), after=after)
+            except Exception:  # pylint: disable=W0718
+                logger.exception("Could not start voice playback in guild %s", self.guild_id)
+                voice_queue_stats["skipped"] += 1
+                continue
+
+            await finished
+            voice_queue_stats["played"] += 1
+
+
+_queues: Dict[int, GuildAudioQueue] = {}
+
+
+def get_voice_queue(guild_id: int) -> GuildAudioQueue:
+    """
+    Return the guild's playback queue, creating it on first use
+    """
+    if guild_id not in _queues:
+        _queues[guild_id] = GuildAudioQueue(guild_id=guild_id)
+    return _queues[guild_id]
+
+
+def queue_speech(voice_client: VoiceClient, priority: int = PRIORITY_COMMAND) -> Optional[SpeechStream]:
+    """
+    Queue a live speech stream on the guild's voice channel. Returns None when the queue is full.
+    """
+    stream = SpeechStream()
+
+    try:
+        get_voice_queue(voice_client.guild.id).enqueue(
+            voice_client=voice_client, make_source=lambda: speech_source(stream), priority=priority, ready=stream.ready
+        )
+    except VoiceQueueFull:
+        return None
+
+    return stream
+
+
+def queue_file(voice_client: VoiceClient, file_path: Path, priority: int = PRIORITY_COMMAND) -> bool:
+    """
+    Queue a finished audio file on the guild's voice channel. Returns False when the queue is full.
+    """
+    try:
+        get_voice_queue(voice_client.guild.id).enqueue(
+            voice_client=voice_client, make_source=lambda: speech_source(file_path), priority=priority
+        )
+    except VoiceQueueFull:
+        return False
+
+    return True